@@ -0,0 +1,346 @@
+"""Animate a terraced terrain by advancing the time offset of the noise.
+
+    python animated_terrain.py [--noise simplex] [--depths 4 5 6 7] [--frames 30]
+
+prints the sustained frame rate of the terrain update at each depth.
+With --check, the terraces sliced by TerraceSlicer are compared with get_mesh() instead.
+"""
+import argparse
+import sys
+import time
+from collections import deque
+
+import numpy as np
+from direct.showbase.ShowBaseGlobal import globalClock
+from panda3d.core import Geom, GeomNode, GeomTriangles, GeomVertexData, GeomEnums, NodePath
+
+from terrain_mesh import TerrainMesh, VertexLayout
+
+
+class TerraceSlicer:
+    """A vectorized version of TerracedTerrainGenerator.create_terraces, which slices
+       all the triangles of a lattice at once. It makes the same roofs and walls,
+       though the order of the triangles is different.
+        Args:
+            generator (TerracedTerrainGenerator): supplies the theme, terrace height and uv.
+            lattice (Lattice): the subdivided triangles.
+    """
+
+    def __init__(self, generator, lattice):
+        self.generator = generator
+        xs, ys = generator.get_lattice_points(lattice)
+        self.xy = np.stack([np.frombuffer(xs), np.frombuffer(ys)], axis=1)
+        self.tris = np.frombuffer(lattice.triangles, dtype=np.uint32).astype(np.int64).reshape(-1, 3)
+
+        layers = [layer for layer in generator.theme]
+        self.thresholds = np.array([layer.threshold for layer in layers[:-1]], dtype=np.float64)
+        self.colors = np.array([layer.rgba for layer in layers], dtype=np.float32)
+
+    def get_planes(self, heights):
+        """Return the triangle index and the height of each plane cutting each triangle.
+        """
+        span = self.generator.terrace_height * 2
+        li = np.trunc(heights[self.tris] / span).astype(np.int64)
+        h_min, h_max = li.min(axis=1), li.max(axis=1)
+
+        counts = (h_max - h_min + 1) * 2
+        tri_ids = np.repeat(np.arange(len(self.tris)), counts)
+        i = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        planes = (h_min[tri_ids] + i * 0.5) * span
+
+        return tri_ids, planes
+
+    def calc_wall_normals(self, xy, h):
+        """A vectorized version of TerracedTerrainGenerator.calc_wall_normal.
+            Args:
+                xy (numpy.ndarray): shape is (n, 3, 2).
+                h (numpy.ndarray): shape is (n, 3).
+        """
+        e1 = np.concatenate([xy[:, 1] - xy[:, 0], (h[:, 1] - h[:, 0])[:, None]], axis=1)
+        e2 = np.concatenate([xy[:, 2] - xy[:, 0], (h[:, 2] - h[:, 0])[:, None]], axis=1)
+        cross = np.cross(e1, e2)
+
+        normals = cross[:, :2] * np.where(cross[:, 2] < 0, -1, 1)[:, None]
+        length = np.hypot(normals[:, 0], normals[:, 1])
+        inv = np.divide(1.0, length, out=np.zeros_like(length), where=length > 0)
+        return normals * inv[:, None]
+
+    def create_vertices(self, xy, z, normals=None):
+        """Args:
+            xy (numpy.ndarray): shape is (n, k, 2).
+            z (numpy.ndarray): shape is (n, k).
+            normals (numpy.ndarray): horizontal normals of the walls, shape is (n, 2); None for roofs.
+        """
+        n, k = z.shape
+        vertices = np.empty((n, k, TerrainMesh.stride), dtype=np.float32)
+        vertices[..., 0:2] = xy
+        vertices[..., 2] = z
+
+        if normals is None:
+            vertices[..., 7:10] = (0, 0, 1)
+        else:
+            vertices[..., 7:9] = normals[:, None, :]
+            vertices[..., 9] = 0
+
+        # calc_uv is plain arithmetic, so it works on the arrays.
+        u, v = self.generator.calc_uv(xy[..., 0], xy[..., 1])
+        vertices[..., 10] = u
+        vertices[..., 11] = v
+        return vertices
+
+    def slice(self, heights):
+        """Return the vertices (float32, shape (n, 12)) and the indices (uint32, shape (m, 3)).
+            Args:
+                heights (numpy.ndarray): the height of each vertex of the lattice.
+        """
+        # the generator compares the heights stored in Point3, i.e. float32.
+        heights = np.asarray(heights, dtype=np.float32).astype(np.float64)
+        tri_ids, planes = self.get_planes(heights)
+        vert_ids = self.tris[tri_ids]
+        above = heights[vert_ids] >= planes[:, None]
+        above_cnt = above.sum(axis=1)
+
+        # rotate the vertices so that v3 is the only vertex above (1) or the only one below (2).
+        single = np.where(above_cnt == 1, np.argmax(above, axis=1), np.argmin(above, axis=1))
+        shift = np.where(above_cnt == 3, 0, (single + 1) % 3)
+        vert_ids = np.take_along_axis(vert_ids, (shift[:, None] + np.arange(3)) % 3, axis=1)
+
+        xy = self.xy[vert_ids]
+        h = heights[vert_ids]
+        h1, h2, h3 = h[:, 0], h[:, 1], h[:, 2]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t1 = np.where(h1 == h3, 0, (h1 - planes) / (h1 - h3))
+            t2 = np.where(h2 == h3, 0, (h2 - planes) / (h2 - h3))
+
+        p1 = xy[:, 0] + (xy[:, 2] - xy[:, 0]) * t1[:, None]
+        p2 = xy[:, 1] + (xy[:, 2] - xy[:, 1]) * t2[:, None]
+        bottoms = planes - self.generator.terrace_height
+
+        # the color is decided by the height of the plane stored as float32, as the generator does.
+        layer = np.searchsorted(self.thresholds, planes.astype(np.float32).astype(np.float64), side='left')
+        colors = self.colors[layer]
+
+        parts = []
+        # (vertices, local indices, colors); see create_terraces.
+        if (m := above_cnt == 3).any():
+            z = np.repeat(planes[m, None], 3, axis=1)
+            parts.append((self.create_vertices(xy[m], z), [(0, 1, 2)], colors[m]))
+
+        if (m := above_cnt == 2).any():
+            z = np.repeat(planes[m, None], 4, axis=1)
+            roof = self.create_vertices(np.stack([xy[m, 0], xy[m, 1], p2[m], p1[m]], axis=1), z)
+            z = np.stack([planes[m], planes[m], bottoms[m], bottoms[m]], axis=1)
+            normals = self.calc_wall_normals(xy[m], h[m])
+            wall = self.create_vertices(np.stack([p1[m], p2[m], p2[m], p1[m]], axis=1), z, normals)
+            indices = [(0, 1, 2), (2, 3, 0), (4, 5, 6), (4, 6, 7)]
+            parts.append((np.concatenate([roof, wall], axis=1), indices, colors[m]))
+
+        if (m := above_cnt == 1).any():
+            z = np.repeat(planes[m, None], 3, axis=1)
+            roof = self.create_vertices(np.stack([xy[m, 2], p1[m], p2[m]], axis=1), z)
+            z = np.stack([planes[m], planes[m], bottoms[m], bottoms[m]], axis=1)
+            normals = self.calc_wall_normals(xy[m], h[m])
+            wall = self.create_vertices(np.stack([p2[m], p1[m], p1[m], p2[m]], axis=1), z, normals)
+            indices = [(0, 1, 2), (3, 4, 6), (4, 5, 6)]
+            parts.append((np.concatenate([roof, wall], axis=1), indices, colors[m]))
+
+        all_vertices = []
+        all_indices = []
+        vertex_cnt = 0
+
+        for vertices, indices, part_colors in parts:
+            n, k, _ = vertices.shape
+            vertices[..., 3:7] = part_colors[:, None, :]
+            starts = vertex_cnt + np.arange(n, dtype=np.int64)[:, None, None] * k
+            all_indices.append((starts + np.array(indices)[None]).reshape(-1, 3))
+            all_vertices.append(vertices.reshape(-1, TerrainMesh.stride))
+            vertex_cnt += n * k
+
+        if not parts:
+            return np.empty((0, TerrainMesh.stride), dtype=np.float32), np.empty((0, 3), dtype=np.uint32)
+
+        return np.concatenate(all_vertices), np.concatenate(all_indices).astype(np.uint32)
+
+
+class AnimatedTerrain:
+    """A class to animate a terraced terrain by advancing the time offset of the noise.
+       Every update, the heights of the cached lattice are calculated again, the terraces
+       are sliced by TerraceSlicer and the vertex data and indices of the same Geom are rewritten.
+        Args:
+            generator (TerracedTerrainGenerator): the generator of the terrain.
+            speed (float): how fast the time offset advances per second.
+    """
+
+    def __init__(self, generator, speed=0.02):
+        self.generator = generator
+        self.speed = speed
+        self.layout = generator.vertex_layout or VertexLayout.STANDARD
+
+        generator.setup_mask()
+        self.lattice = generator.lattice_cache.get(generator)
+        self.slicer = TerraceSlicer(generator, self.lattice)
+        self.t, self.offsets = generator.get_noise_domain()
+        self.update_times = deque(maxlen=60)
+
+        self.geom = self.create_geom()
+        geom_node = GeomNode('animated_terraced_terrain')
+        geom_node.add_geom(self.geom)
+        self.model = NodePath(geom_node)
+        self.update_geom()
+
+    def create_geom(self):
+        fmt = TerrainMesh(np.empty((0, TerrainMesh.stride)), np.empty((0, 3))).create_format(self.layout)
+        vdata = GeomVertexData('animated_terraced_terrain', fmt, Geom.UH_dynamic)
+        prim = GeomTriangles(Geom.UH_dynamic)
+        prim.set_index_type(GeomEnums.NT_uint32)
+
+        geom = Geom(vdata)
+        geom.add_primitive(prim)
+        return geom
+
+    def update_geom(self):
+        start = time.perf_counter()
+        # the time offset changes every frame, so the octave cache of the generator is not used.
+        heights = [self.generator.get_height(x, y, self.t, self.offsets) for x, y in self.slicer.xy.tolist()]
+        vertices, indices = self.slicer.slice(heights)
+        mesh = TerrainMesh(vertices, indices)
+
+        vdata = self.geom.modify_vertex_data()
+        vdata.unclean_set_num_rows(mesh.num_vertices)
+        vdata.modify_array_handle(0).copy_data_from(mesh.pack_vertices(self.layout).view(np.uint8))
+
+        prim_array = self.geom.modify_primitive(0).modify_vertices()
+        prim_array.unclean_set_num_rows(mesh.num_triangles * 3)
+        prim_array.modify_handle().copy_data_from(np.ascontiguousarray(mesh.indices).view(np.uint8))
+
+        self.update_times.append(time.perf_counter() - start)
+
+    def step(self, dt):
+        self.t += self.speed * dt
+        self.update_geom()
+
+    def update(self, task):
+        """A task function; add this to the task manager to animate the terrain every frame.
+        """
+        dt = globalClock.get_dt()
+        self.step(dt)
+        return task.cont
+
+    def get_sustained_fps(self):
+        """Return the frame rate which the updates alone can sustain.
+        """
+        if not self.update_times:
+            return 0.0
+        return len(self.update_times) / sum(self.update_times)
+
+
+def match_triangles(expected, actual, tolerance):
+    """Match each triangle of expected with the nearest unmatched one of actual and
+       return the largest difference of the matched features; inf if any triangle
+       has no counterpart within tolerance. The candidates are looked up in a grid
+       of the mean positions, so features rounded to different sides of a cell still match.
+        Args:
+            expected, actual (numpy.ndarray): features of the triangles; shape is (n, 12).
+    """
+    cells = {}
+    for j, key in enumerate(map(tuple, np.floor(actual[:, :3] / tolerance).astype(np.int64))):
+        cells.setdefault(key, []).append(j)
+
+    neighbors = [(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]
+    keys = np.floor(expected[:, :3] / tolerance).astype(np.int64)
+    max_diff = 0.0
+
+    for feature, (x, y, z) in zip(expected, keys):
+        best, best_diff = None, tolerance
+
+        for dx, dy, dz in neighbors:
+            cell = cells.get((x + dx, y + dy, z + dz), [])
+
+            for j in cell:
+                if (diff := np.abs(actual[j] - feature).max()) <= best_diff:
+                    best, best_diff = (cell, j), diff
+
+        if best is None:
+            return np.inf
+
+        cell, j = best
+        cell.remove(j)
+        max_diff = max(max_diff, float(best_diff))
+
+    return max_diff
+
+
+def compare_with_generator(generator, tolerance=1e-3):
+    """Slice the lattice of the generator by TerraceSlicer and compare the triangles with
+       get_mesh(), ignoring their order. Return the numbers of the triangles of both
+       and the largest difference of the vertex attributes; inf if the triangles do not match.
+    """
+    mesh = generator.get_mesh()
+    lattice = generator.lattice_cache.get(generator)
+    t, offsets = generator.get_noise_domain()
+    vertices, indices = TerraceSlicer(generator, lattice).slice(
+        generator.get_lattice_heights(lattice, t, offsets))
+
+    def get_features(vertices, indices):
+        # the mean of the attributes of the three vertices does not depend on their order.
+        return vertices[indices.astype(np.int64)].astype(np.float64).mean(axis=1)
+
+    if len(indices) != mesh.num_triangles:
+        return mesh.num_triangles, len(indices), np.inf
+
+    expected = get_features(mesh.vertices, mesh.indices)
+    diff = match_triangles(expected, get_features(vertices, indices), tolerance)
+    return mesh.num_triangles, len(indices), diff
+
+
+def benchmark(constructor, depths, frames, dt=1 / 60):
+    results = {}
+
+    for max_depth in depths:
+        generator = constructor(max_depth=max_depth)
+        terrain = AnimatedTerrain(generator)
+        terrain.update_times.clear()
+
+        for _ in range(frames):
+            terrain.step(dt)
+
+        results[max_depth] = terrain.get_sustained_fps()
+
+    return results
+
+
+def main():
+    from terraced_terrain_generator import TerracedTerrainGenerator
+
+    parser = argparse.ArgumentParser(description='Measure the sustained frame rate of the animation.')
+    parser.add_argument('--noise', default='simplex', choices=['simplex', 'perlin', 'cellular', 'fractal'])
+    parser.add_argument('--depths', type=int, nargs='+', default=[4, 5, 6, 7])
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--check', action='store_true',
+                        help='compare the slicer with get_mesh() for each theme instead.')
+    args = parser.parse_args()
+
+    constructor = getattr(TerracedTerrainGenerator, f'from_{args.noise}')
+
+    if args.check:
+        failed = False
+        print(f'{"theme":<14}{"max_depth":>9}{"generator":>11}{"slicer":>9}{"max diff":>11}')
+
+        for theme in ('mountain', 'snowmountain', 'desert', 'island'):
+            for max_depth in args.depths:
+                expected, actual, diff = compare_with_generator(
+                    constructor(max_depth=max_depth, theme=theme, seed=4))
+                failed |= expected != actual or diff > 1e-4
+                print(f'{theme:<14}{max_depth:>9}{expected:>11}{actual:>9}{diff:>11.2e}')
+
+        sys.exit(1 if failed else 0)
+
+    print(f'{"max_depth":>9}{"fps":>10}')
+
+    for max_depth, fps in benchmark(constructor, args.depths, args.frames).items():
+        print(f'{max_depth:>9}{fps:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
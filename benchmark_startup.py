@@ -0,0 +1,68 @@
+"""Measure the cold start of terraced_terrain_generator.
+
+Each constructor is measured in a new process: the time to import the module,
+the time of the first create() and whether numpy and OpenCV are loaded by the import.
+
+    python benchmark_startup.py [--budget 0.5] [--max_depth 6]
+"""
+import argparse
+import json
+import pathlib
+import subprocess
+import sys
+
+
+# Importing terraced_terrain_generator, including panda3d.core, should finish within this time (seconds).
+IMPORT_BUDGET = 0.5
+
+CONSTRUCTORS = ['from_simplex', 'from_perlin', 'from_cellular', 'from_fractal']
+
+CODE = '''
+import json
+import sys
+import time
+
+start = time.perf_counter()
+from terraced_terrain_generator import TerracedTerrainGenerator
+import_time = time.perf_counter() - start
+loaded = [name for name in ('numpy', 'cv2', 'noise') if name in sys.modules]
+
+start = time.perf_counter()
+generator = getattr(TerracedTerrainGenerator, '{constructor}')(max_depth={max_depth})
+generator.create()
+create_time = time.perf_counter() - start
+
+print(json.dumps(dict(import_time=import_time, create_time=create_time, loaded=loaded)))
+'''
+
+
+def measure(constructor, max_depth):
+    code = CODE.format(constructor=constructor, max_depth=max_depth)
+    # run in this directory, from which the code imports the modules.
+    cwd = pathlib.Path(__file__).resolve().parent
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=cwd)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import and the first create() in new processes.')
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET, help='import time budget in seconds.')
+    parser.add_argument('--max_depth', type=int, default=6)
+    args = parser.parse_args()
+
+    over_budget = False
+    print(f'{"constructor":<15}{"import [s]":>12}{"create [s]":>12}  loaded by import')
+
+    for constructor in CONSTRUCTORS:
+        result = measure(constructor, args.max_depth)
+        over_budget |= result['import_time'] > args.budget
+        loaded = ', '.join(result['loaded']) or '-'
+        print(f'{constructor:<15}{result["import_time"]:>12.3f}{result["create_time"]:>12.3f}  {loaded}')
+
+    if over_budget:
+        print(f'import time exceeds the budget of {args.budget} s.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import numpy as np
+from panda3d.core import CollisionNode, CollisionPolygon, Point3
+
+
+class CollisionMesh:
+    """A lightweight collision shape of a terraced terrain, made from a heightfield
+       of terrace heights. Cells of the same height are merged into rectangular roofs
+       and vertical walls are put between cells of different heights.
+       The number of polygons depends on cell_size, not on max_depth of the terrain.
+        Args:
+            heights (numpy.ndarray): terrace heights of the cells; shape is (rows, cols); nan outside the terrain.
+            origin (tuple): (x, y) of the corner of the first cell.
+            cell_size (float): length of a side of a cell.
+    """
+
+    def __init__(self, heights, origin, cell_size):
+        self.heights = heights
+        self.origin = origin
+        self.cell_size = cell_size
+        self.roofs = self.merge_roofs()
+        self.walls = np.concatenate([self.merge_walls(axis=0), self.merge_walls(axis=1)])
+
+    @classmethod
+    def from_height_index(cls, height_index, cell_size):
+        """Sample the heights at the centers of the cells from HeightIndex.
+        """
+        tris = height_index.tris[:, :, :2].reshape(-1, 2)
+        if len(tris) == 0:
+            return cls(np.full((0, 0), np.nan), (0, 0), cell_size)
+
+        origin = tris.min(axis=0)
+        cols, rows = np.ceil((tris.max(axis=0) - origin) / cell_size).astype(np.int64)
+        xs = origin[0] + (np.arange(cols) + 0.5) * cell_size
+        ys = origin[1] + (np.arange(rows) + 0.5) * cell_size
+        x, y = np.meshgrid(xs, ys)
+        heights, _ = height_index.get_heights(x, y)
+
+        return cls(heights.reshape(rows, cols), tuple(origin), cell_size)
+
+    def cell_to_xy(self, col, row):
+        return (self.origin[0] + col * self.cell_size, self.origin[1] + row * self.cell_size)
+
+    def merge_roofs(self):
+        """Merge cells of the same height into rectangles greedily.
+        """
+        rows, cols = self.heights.shape
+        done = np.isnan(self.heights)
+        quads = []
+
+        for r in range(rows):
+            for c in range(cols):
+                if done[r, c]:
+                    continue
+
+                h = self.heights[r, c]
+                c_end = c + 1
+                while c_end < cols and not done[r, c_end] and self.heights[r, c_end] == h:
+                    c_end += 1
+
+                r_end = r + 1
+                while r_end < rows and not done[r_end, c:c_end].any() \
+                        and (self.heights[r_end, c:c_end] == h).all():
+                    r_end += 1
+
+                done[r:r_end, c:c_end] = True
+                x0, y0 = self.cell_to_xy(c, r)
+                x1, y1 = self.cell_to_xy(c_end, r_end)
+                quads.append([(x0, y0, h), (x1, y0, h), (x1, y1, h), (x0, y1, h)])
+
+        return np.array(quads, dtype=np.float32).reshape(-1, 4, 3)
+
+    def merge_walls(self, axis):
+        """Create walls between adjacent cells of different heights. The walls along
+           the same edge line with the same bottom and top are merged.
+            Args:
+                axis (int): 1 for walls between columns, 0 for walls between rows.
+        """
+        heights = self.heights if axis == 1 else self.heights.T
+        lines, length = heights.shape
+        quads = []
+
+        for i in range(length - 1):
+            a, b = heights[:, i], heights[:, i + 1]
+            lo, hi = np.fmin(a, b), np.fmax(a, b)
+            # the wall faces the lower side.
+            face = np.where(a < b, -1, 1)
+            is_wall = ~np.isnan(a) & ~np.isnan(b) & (a != b)
+            j = 0
+
+            while j < lines:
+                if not is_wall[j]:
+                    j += 1
+                    continue
+
+                k = j + 1
+                while k < lines and is_wall[k] and lo[k] == lo[j] \
+                        and hi[k] == hi[j] and face[k] == face[j]:
+                    k += 1
+
+                quads.append(self.create_wall(axis, i + 1, j, k, lo[j], hi[j], face[j]))
+                j = k
+
+        return np.array(quads, dtype=np.float32).reshape(-1, 4, 3)
+
+    def create_wall(self, axis, edge, start, end, lo, hi, face):
+        if axis == 1:
+            (x, y0), (_, y1) = self.cell_to_xy(edge, start), self.cell_to_xy(edge, end)
+            quad = [(x, y0, lo), (x, y1, lo), (x, y1, hi), (x, y0, hi)]
+            # counter-clockwise seen from +x.
+            return quad if face > 0 else quad[::-1]
+
+        (x0, y), (x1, _) = self.cell_to_xy(start, edge), self.cell_to_xy(end, edge)
+        quad = [(x0, y, lo), (x0, y, hi), (x1, y, hi), (x1, y, lo)]
+        # counter-clockwise seen from +y.
+        return quad if face > 0 else quad[::-1]
+
+    @property
+    def num_polygons(self):
+        return len(self.roofs) + len(self.walls)
+
+    def get_arrays(self):
+        """Return the roofs and the walls as float32 arrays of shape (n, 4, 3).
+        """
+        return self.roofs, self.walls
+
+    def create_collision_node(self, name='terraced_terrain_collision'):
+        node = CollisionNode(name)
+
+        for quad in np.concatenate([self.roofs, self.walls]):
+            node.add_solid(CollisionPolygon(*[Point3(*pt) for pt in quad]))
+
+        return node
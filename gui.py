@@ -67,6 +67,33 @@ class Label(DirectLabel):
         self.initialiseoptions(type(self))
 
 
+class Overlay(DirectLabel):
+
+    def __init__(self, parent, pos):
+        super().__init__(
+            parent=parent,
+            pos=pos,
+            frameColor=LColor(0, 0, 0, 0.5),
+            pad=(0.02, 0.02),
+            text='',
+            text_fg=Gui.text_color,
+            text_scale=0.04,
+            text_align=TextNode.ALeft
+        )
+        self.initialiseoptions(type(self))
+        self.hide()
+
+    def toggle(self):
+        if self.is_hidden():
+            self.show()
+        else:
+            self.hide()
+
+    def set_text(self, lines):
+        self['text'] = '\n'.join(lines)
+        self.resetFrameSize()
+
+
 class Entry(DirectEntry):
 
     def __init__(self, parent, pos, txt='', width=4):
@@ -128,6 +155,8 @@ class Gui(DirectFrame):
             self, 'Output BamFile', Point3(0, 0, start_z - 0.1), base.output_bam_file))
         self.btns.append(Button(
             self, 'Toggle Wireframe', Point3(0, 0, start_z - 0.2), base.toggle_wireframe))
+        self.btns.append(Button(
+            self, 'Toggle Overlay', Point3(0, 0, start_z - 0.3), base.toggle_overlay))
 
     def create_entries(self, start_z):
         """Create entry boxes and their labels.
@@ -144,14 +173,14 @@ class Gui(DirectFrame):
     def create_radios(self, start_z):
         """Create radio buttons to select a noise and a theme.
         """
-        noises = ['SimplexNoise', 'CelullarNoise', 'PerlinNoise', 'SimplexFractalNoise']
-        themes = ['Mountain', 'SnowMountain', 'Desert', 'Island']
-        self.noise = noises[:1]
-        self.theme = themes[:1]
+        self.noises = ['SimplexNoise', 'CelullarNoise', 'PerlinNoise', 'SimplexFractalNoise']
+        self.themes = ['Mountain', 'SnowMountain', 'Desert', 'Island']
+        self.noise = self.noises[:1]
+        self.theme = self.themes[:1]
 
         items = [
-            [noises, self.noise, base.create_terrain_generator],
-            [themes, self.theme, ''],
+            [self.noises, self.noise, base.create_terrain_generator],
+            [self.themes, self.theme, ''],
         ]
 
         for names, variable, func in items:
@@ -0,0 +1,133 @@
+import numpy as np
+
+
+class HeightIndex:
+    """A uniform grid over the roof triangles of a terraced terrain to get
+       the ground height and terrace level at any (x, y) in the model space.
+       Each cell has the roof triangles overlapping it, sorted from the highest,
+       so the first triangle containing a point gives the visible roof.
+        Args:
+            mesh (TerrainMesh): the terrain.
+            cell_size (float): length of a side of a cell; about the size of the smallest triangles.
+    """
+
+    def __init__(self, mesh, cell_size):
+        self.cell_size = cell_size
+
+        # the roofs have upward normals; the normals of the walls are horizontal.
+        is_roof = mesh.normals[mesh.indices[:, 0], 2] > 0.5
+        tris = mesh.positions[mesh.indices[is_roof]].astype(np.float64)
+        levels = mesh.levels[is_roof]
+
+        # the higher roof comes first in each cell.
+        order = np.argsort(-tris[:, 0, 2], kind='stable')
+        self.tris = tris[order]
+        self.levels = levels[order]
+        self.heights = self.tris[:, 0, 2]
+        self.setup_barycentric()
+
+        if len(self.tris) == 0:
+            self.origin = np.zeros(2)
+            self.cols = self.rows = 0
+            self.cell_start = np.zeros(1, dtype=np.int64)
+            self.cell_tris = np.zeros(0, dtype=np.int64)
+            return
+
+        xy = self.tris[:, :, :2]
+        self.origin = xy.reshape(-1, 2).min(axis=0)
+        lo = np.floor((xy.min(axis=1) - self.origin) / cell_size).astype(np.int64)
+        hi = np.floor((xy.max(axis=1) - self.origin) / cell_size).astype(np.int64)
+        self.cols, self.rows = hi.max(axis=0) + 1
+        self.build_cells(lo, hi)
+
+    def setup_barycentric(self):
+        """Precompute the values to calculate barycentric coordinates of each triangle.
+        """
+        a = self.tris[:, 0, :2]
+        self.a = a
+        self.e1 = self.tris[:, 1, :2] - a
+        self.e2 = self.tris[:, 2, :2] - a
+        det = self.e1[:, 0] * self.e2[:, 1] - self.e1[:, 1] * self.e2[:, 0]
+        # degenerated triangles never contain points.
+        self.inv_det = np.divide(1.0, det, out=np.zeros_like(det), where=det != 0)
+
+    def build_cells(self, lo, hi):
+        n_x = hi[:, 0] - lo[:, 0] + 1
+        n_y = hi[:, 1] - lo[:, 1] + 1
+        counts = n_x * n_y
+
+        tri_ids = np.repeat(np.arange(len(counts)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        gx = lo[tri_ids, 0] + local % n_x[tri_ids]
+        gy = lo[tri_ids, 1] + local // n_x[tri_ids]
+        cells = gy * self.cols + gx
+
+        # stable sort keeps the order from the highest roof within each cell.
+        order = np.argsort(cells, kind='stable')
+        self.cell_tris = tri_ids[order]
+        self.cell_start = np.searchsorted(cells[order], np.arange(self.cols * self.rows + 1))
+
+    def get_cells(self, x, y):
+        gx = np.floor((x - self.origin[0]) / self.cell_size).astype(np.int64)
+        gy = np.floor((y - self.origin[1]) / self.cell_size).astype(np.int64)
+        inside = (gx >= 0) & (gx < self.cols) & (gy >= 0) & (gy < self.rows)
+        return np.where(inside, gy * self.cols + gx, -1)
+
+    def contains(self, tri_ids, x, y, eps=1e-9):
+        px = x - self.a[tri_ids, 0]
+        py = y - self.a[tri_ids, 1]
+        e1, e2, inv = self.e1[tri_ids], self.e2[tri_ids], self.inv_det[tri_ids]
+        s = (px * e2[:, 1] - py * e2[:, 0]) * inv
+        t = (e1[:, 0] * py - e1[:, 1] * px) * inv
+        return (inv != 0) & (s >= -eps) & (t >= -eps) & (s + t <= 1 + eps)
+
+    def get_heights(self, x, y):
+        """Return the heights and the terrace levels at the points. Points outside
+           the terrain get nan as the height and -1 as the level.
+            Args:
+                x (numpy.ndarray): x coordinates.
+                y (numpy.ndarray): y coordinates.
+        """
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64).ravel()
+        heights = np.full(len(x), np.nan)
+        levels = np.full(len(x), -1, dtype=np.int32)
+
+        cells = self.get_cells(x, y)
+        pending = np.nonzero(cells >= 0)[0]
+        start = self.cell_start[cells[pending]]
+        stop = self.cell_start[cells[pending] + 1]
+        k = 0
+
+        # check the k-th triangle in the cell of every pending point at once.
+        while len(pending) > 0:
+            has_tri = start + k < stop
+            pending, start, stop = pending[has_tri], start[has_tri], stop[has_tri]
+            if len(pending) == 0:
+                break
+
+            tri_ids = self.cell_tris[start + k]
+            hit = self.contains(tri_ids, x[pending], y[pending])
+            heights[pending[hit]] = self.heights[tri_ids[hit]]
+            levels[pending[hit]] = self.levels[tri_ids[hit]]
+
+            pending, start, stop = pending[~hit], start[~hit], stop[~hit]
+            k += 1
+
+        return heights, levels
+
+    def get_height(self, x, y):
+        """Return the height and the terrace level at (x, y), or None if the
+           point is outside the terrain.
+        """
+        cell = self.get_cells(np.array([x]), np.array([y]))[0]
+        if cell < 0:
+            return None
+
+        for i in range(self.cell_start[cell], self.cell_start[cell + 1]):
+            tri_id = self.cell_tris[i]
+
+            if self.contains(np.array([tri_id]), x, y)[0]:
+                return float(self.heights[tri_id]), int(self.levels[tri_id])
+
+        return None
@@ -0,0 +1,107 @@
+import array
+import threading
+from collections import OrderedDict
+
+
+class Lattice:
+    """An immutable template of the subdivided triangles of a terrain, which depends
+       only on the ground polygon and max_depth; not on the noise, the seed nor the theme.
+       The coordinates are in the frame of the generator's lattice; see get_lattice_points.
+       The arrays must not be modified.
+        Args:
+            xs (array.array): x of each vertex shared by the triangles.
+            ys (array.array): y of each vertex.
+            triangles (array.array): indices of the three vertices of each triangle,
+                                     flattened in generation order.
+    """
+
+    __slots__ = ('xs', 'ys', 'triangles')
+
+    def __init__(self, xs, ys, triangles):
+        object.__setattr__(self, 'xs', xs)
+        object.__setattr__(self, 'ys', ys)
+        object.__setattr__(self, 'triangles', triangles)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Lattice is immutable.')
+
+    @classmethod
+    def from_triangles(cls, triangles):
+        """Build a lattice from the subdivided triangles, each of which is a list of Point3.
+        """
+        xs = array.array('d')
+        ys = array.array('d')
+        indices = array.array('I')
+        index = {}
+
+        for tri in triangles:
+            for vert in tri:
+                if (i := index.get(key := (vert.x, vert.y))) is None:
+                    i = index[key] = len(xs)
+                    xs.append(key[0])
+                    ys.append(key[1])
+                indices.append(i)
+
+        return cls(xs, ys, indices)
+
+    @property
+    def num_points(self):
+        return len(self.xs)
+
+    @property
+    def num_triangles(self):
+        return len(self.triangles) // 3
+
+    def iter_triangles(self):
+        """Yield the indices of the three vertices of each triangle.
+        """
+        it = iter(self.triangles)
+        return zip(it, it, it)
+
+
+class LatticeCache:
+    """A bounded LRU cache of Lattice objects shared by generators.
+        Args:
+            max_points (int): the maximum number of vertices of all the lattices kept;
+                              a lattice larger than this is built but not kept.
+    """
+
+    def __init__(self, max_points=1_000_000):
+        self.max_points = max_points
+        self.lattices = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, generator):
+        key = generator.get_lattice_key()
+
+        with self.lock:
+            if (lattice := self.lattices.get(key)) is not None:
+                self.lattices.move_to_end(key)
+                self.hits += 1
+                return lattice
+
+            self.misses += 1
+
+        lattice = generator.create_lattice()
+
+        if lattice.num_points > self.max_points:
+            return lattice
+
+        with self.lock:
+            if key not in self.lattices:
+                self.lattices[key] = lattice
+                self.size += lattice.num_points
+
+            while self.size > self.max_points:
+                _, evicted = self.lattices.popitem(last=False)
+                self.size -= evicted.num_points
+
+        return lattice
+
+    def clear(self):
+        with self.lock:
+            self.lattices.clear()
+            self.size = 0
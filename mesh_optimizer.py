@@ -0,0 +1,181 @@
+from collections import deque, namedtuple
+
+import numpy as np
+
+from terrain_mesh import TerrainMesh
+
+
+# ACMR (average cache miss ratio) is the number of vertex shader invocations per triangle
+# on a FIFO post-transform cache; 3.0 means no reuse, about 0.5 is the best for grids.
+OptimizationReport = namedtuple(
+    'OptimizationReport',
+    'vertices_before vertices_after acmr_before acmr_welded acmr_after'
+)
+
+
+class VertexCacheOptimizer:
+    """A class to reorder the triangles of a TerrainMesh for the post-transform vertex cache
+       and for less overdraw, based on Tipsify (Sander et al., "Fast Triangle Reordering
+       for Vertex Locality and Reduced Overdraw", 2007).
+       Because the generator writes separate vertices for most triangles, identical vertices
+       are welded first; otherwise no vertex could be reused whatever the order.
+        Args:
+            cache_size (int): the number of entries of the simulated FIFO cache.
+    """
+
+    def __init__(self, cache_size=16):
+        self.cache_size = cache_size
+
+    def calc_acmr(self, indices):
+        if (tri_cnt := len(indices)) == 0:
+            return 0.0
+
+        cache = deque()
+        cached = set()
+        misses = 0
+
+        for v in np.asarray(indices).ravel().tolist():
+            if v in cached:
+                continue
+
+            misses += 1
+            cache.append(v)
+            cached.add(v)
+
+            if len(cache) > self.cache_size:
+                cached.discard(cache.popleft())
+
+        return misses / tri_cnt
+
+    def weld(self, mesh):
+        """Merge the vertices having exactly the same attributes, keeping the order of first appearance.
+        """
+        rows = np.ascontiguousarray(mesh.vertices).view(
+            np.dtype((np.void, mesh.vertices.dtype.itemsize * mesh.stride))).ravel()
+        _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+
+        order = np.argsort(first)
+        remap = np.empty_like(order)
+        remap[order] = np.arange(len(order))
+        indices = remap[inverse.ravel()][mesh.indices.astype(np.int64)]
+
+        return TerrainMesh(mesh.vertices[first[order]], indices, mesh.levels)
+
+    def tipsify(self, indices, vertex_cnt):
+        """Return the new order of the triangles and the positions in it
+           where the fanning restarted from a distant vertex (hard boundaries).
+        """
+        tris = indices.tolist()
+        k = self.cache_size
+
+        # triangles adjacent to each vertex
+        adjacency = [[] for _ in range(vertex_cnt)]
+        for t, tri in enumerate(tris):
+            for v in tri:
+                adjacency[v].append(t)
+
+        live = [len(a) for a in adjacency]
+        cache_time = [0] * vertex_cnt
+        emitted = [False] * len(tris)
+        dead_end = []
+        order = []
+        boundaries = [0]
+
+        timestamp = k + 1
+        cursor = 1
+        f = 0 if vertex_cnt > 0 else -1
+
+        while f >= 0:
+            candidates = []
+
+            for t in adjacency[f]:
+                if emitted[t]:
+                    continue
+
+                emitted[t] = True
+                order.append(t)
+
+                for v in tris[t]:
+                    dead_end.append(v)
+                    candidates.append(v)
+                    live[v] -= 1
+
+                    if timestamp - cache_time[v] > k:
+                        cache_time[v] = timestamp
+                        timestamp += 1
+
+            # choose the next fanning vertex among the candidates still in the cache.
+            f, best = -1, -1
+            for v in candidates:
+                if live[v] > 0:
+                    p = 0
+                    if timestamp - cache_time[v] + 2 * live[v] <= k:
+                        p = timestamp - cache_time[v]
+                    if p > best:
+                        f, best = v, p
+
+            if f < 0:
+                while dead_end:
+                    if live[v := dead_end.pop()] > 0:
+                        f = v
+                        break
+
+                while f < 0 and cursor < vertex_cnt:
+                    if live[cursor] > 0:
+                        f = cursor
+                    cursor += 1
+
+                if f >= 0:
+                    boundaries.append(len(order))
+
+        return np.array(order, dtype=np.int64), boundaries
+
+    def sort_clusters(self, mesh, order, boundaries):
+        """Sort the clusters between hard boundaries so that the ones facing outward,
+           which tend to occlude the others, are drawn first.
+        """
+        pts = mesh.positions[mesh.indices[order].astype(np.int64)].astype(np.float64)
+        centroids = pts.mean(axis=1)
+        normals = np.cross(pts[:, 1] - pts[:, 0], pts[:, 2] - pts[:, 0])
+        mesh_center = centroids.mean(axis=0) if len(centroids) else np.zeros(3)
+
+        bounds = boundaries + [len(order)]
+        clusters = [(s, e) for s, e in zip(bounds, bounds[1:]) if e > s]
+        metrics = []
+
+        for s, e in clusters:
+            n = normals[s:e].sum(axis=0)
+            if (length := np.linalg.norm(n)) > 0:
+                n /= length
+            metrics.append(np.dot(centroids[s:e].mean(axis=0) - mesh_center, n))
+
+        sorted_clusters = [clusters[i] for i in np.argsort(metrics, kind='stable')[::-1]]
+        return np.concatenate([order[s:e] for s, e in sorted_clusters]) if clusters else order
+
+    def optimize(self, mesh, reduce_overdraw=True):
+        """Return the reordered mesh and an OptimizationReport.
+        """
+        acmr_before = self.calc_acmr(mesh.indices)
+        welded = self.weld(mesh)
+        acmr_welded = self.calc_acmr(welded.indices)
+
+        order, boundaries = self.tipsify(welded.indices, welded.num_vertices)
+        if reduce_overdraw:
+            order = self.sort_clusters(welded, order, boundaries)
+
+        indices = welded.indices[order]
+        levels = welded.levels[order]
+
+        # renumber the vertices in the order of first use.
+        flat = indices.ravel()
+        _, first = np.unique(flat, return_index=True)
+        used = flat[np.sort(first)]
+        remap = np.empty(welded.num_vertices, dtype=np.int64)
+        remap[used] = np.arange(len(used))
+        optimized = TerrainMesh(welded.vertices[used], remap[flat], levels)
+
+        report = OptimizationReport(
+            mesh.num_vertices, optimized.num_vertices,
+            acmr_before, acmr_welded, self.calc_acmr(optimized.indices)
+        )
+        return optimized, report
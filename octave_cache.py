@@ -0,0 +1,62 @@
+import array
+import threading
+from collections import OrderedDict
+
+
+class OctaveCache:
+    """A bounded LRU cache of the raw noise of each octave at each vertex of a lattice.
+       The noise of an octave depends only on the lattice, the noise function, the scale,
+       the time offset, the octave's offset and its frequency; not on the number of octaves
+       nor on the amplitude, so adding an octave or changing persistence calls no noise
+       for the octaves already stored.
+        Args:
+            max_values (int): the maximum number of noise values kept in all entries.
+    """
+
+    def __init__(self, max_values=2_000_000):
+        self.max_values = max_values
+        self.octaves = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, generator, lattice, xs, ys, t, offset, frequency):
+        """Return array.array of the noise of one octave at the points of the lattice.
+            Args:
+                xs, ys (array.array): the points of the lattice placed on the terrain by the generator.
+        """
+        # Lattice has no __eq__, so the same lattice object is required; it is kept by the key.
+        # A lattice can be shared by translated terrains, so the center is also a part of the key.
+        key = (lattice, generator.center.x, generator.center.y, generator.noise,
+               generator.scale, t, offset.x, offset.y, frequency)
+
+        with self.lock:
+            if (values := self.octaves.get(key)) is not None:
+                self.octaves.move_to_end(key)
+                self.hits += 1
+                return values
+
+            self.misses += 1
+
+        noise, scale = generator.noise, generator.scale
+        values = array.array('d', [
+            noise((x * frequency + offset.x + t) * scale, (y * frequency + offset.y + t) * scale)
+            for x, y in generator.watch_cancel(zip(xs, ys))
+        ])
+
+        with self.lock:
+            if key not in self.octaves:
+                self.octaves[key] = values
+                self.size += len(values)
+
+            while self.size > self.max_values and len(self.octaves) > 1:
+                _, evicted = self.octaves.popitem(last=False)
+                self.size -= len(evicted)
+
+        return values
+
+    def clear(self):
+        with self.lock:
+            self.octaves.clear()
+            self.size = 0
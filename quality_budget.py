@@ -0,0 +1,193 @@
+import json
+import pathlib
+import time
+from collections import namedtuple
+
+
+BudgetReport = namedtuple(
+    'BudgetReport',
+    'max_depth octaves predicted_time actual_time predicted_memory actual_memory'
+)
+
+
+def get_geom_memory(geom_node):
+    """Return the size in bytes of the vertex data and the indices of a GeomNode.
+    """
+    size = 0
+
+    for i in range(geom_node.get_num_geoms()):
+        geom = geom_node.get_geom(i)
+        vdata = geom.get_vertex_data()
+        size += sum(vdata.get_array(j).get_data_size_bytes() for j in range(vdata.get_num_arrays()))
+        size += sum(geom.get_primitive(j).get_vertices().get_data_size_bytes()
+                    for j in range(geom.get_num_primitives()))
+
+    return size
+
+
+class QualityBudget:
+    """A class to select max_depth, and octaves if allowed, of a generator so that
+       the generation fits the time budget and the memory budget.
+       The cost per triangle of the subdivision is measured by generating a small terrain
+       on this machine, and the result is cached in memory and in cache_file.
+       At least one of the budgets is required; without them depth_limit would always be selected.
+        Args:
+            time_budget (float): seconds allowed for the generation; None for no limit.
+            memory_budget (int): bytes allowed for the vertex data and indices; None for no limit.
+            max_octaves (int): if given, octaves can be changed from 1 up to this value.
+            depth_limit (int): the largest max_depth to be selected.
+            cache_file (str): the path of the file to store the calibration; None not to store.
+    """
+
+    calibration_depth = 5
+    calibrations = {}
+    default_cache_file = pathlib.Path.home() / '.cache' / 'terraced_terrain' / 'calibration.json'
+
+    def __init__(self, time_budget=None, memory_budget=None, max_octaves=None,
+                 depth_limit=12, cache_file=default_cache_file):
+        if time_budget is None and memory_budget is None:
+            raise ValueError('time_budget or memory_budget must be specified.')
+
+        self.time_budget = time_budget
+        self.memory_budget = memory_budget
+        self.max_octaves = max_octaves
+        self.depth_limit = depth_limit
+        self.cache_file = cache_file
+        self.report = None
+
+    def get_key(self, generator):
+        """Return the key of the calibration, made of all the settings
+           affecting the cost per triangle except max_depth.
+        """
+        noise = generator.noise
+        noise_name = getattr(noise, '__qualname__', type(noise).__name__)
+        layout = getattr(generator.vertex_layout, 'name', 'STANDARD')
+        values = [
+            noise_name, generator.theme.__name__, layout, generator.scale, generator.segs_c,
+            generator.radius, generator.octaves, generator.terrace_height, generator.frequency,
+            generator.persistence, generator.lacunarity, generator.optimize_vertex_cache,
+            generator.build_height_index
+        ]
+        return '|'.join(str(v) for v in values)
+
+    @classmethod
+    def clear_cache(cls, cache_file=default_cache_file):
+        """Discard the calibrations in memory and in cache_file, so that they are measured again.
+        """
+        cls.calibrations.clear()
+
+        if cache_file is not None:
+            pathlib.Path(cache_file).unlink(missing_ok=True)
+
+    def load_cache(self):
+        if self.cache_file is None:
+            return {}
+
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self, key, calibration):
+        if self.cache_file is None:
+            return
+
+        cache = self.load_cache()
+        cache[key] = calibration
+
+        try:
+            path = pathlib.Path(self.cache_file)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(cache, f, indent=2)
+        except OSError:
+            pass
+
+    def count_triangles(self, generator, max_depth):
+        """Return the number of the triangles made by the subdivision.
+        """
+        return generator.segs_c * 4 ** (max_depth - 1)
+
+    def calibrate(self, generator):
+        """Return the costs per subdivided triangle: the time of heights per octave,
+           the time of terraces and the GeomNode, and the bytes of the output.
+        """
+        key = self.get_key(generator)
+
+        if (calibration := self.calibrations.get(key)) is not None:
+            return calibration
+
+        if (calibration := self.load_cache().get(key)) is None:
+            org_depth, org_seed, org_cache = generator.max_depth, generator.seed, generator.octave_cache
+            generator.max_depth = self.calibration_depth
+            generator.seed = 0 if org_seed is None else org_seed
+            # measure the noise itself, not the octaves cached by earlier generations.
+            generator.octave_cache = None
+
+            try:
+                geom_node = generator.get_geom_node()
+            finally:
+                generator.max_depth, generator.seed, generator.octave_cache = org_depth, org_seed, org_cache
+
+            tri_cnt = self.count_triangles(generator, self.calibration_depth)
+            stages = generator.stage_times
+            calibration = dict(
+                height_time=stages['heights'] / (tri_cnt * max(generator.octaves, 1)),
+                other_time=(sum(stages.values()) - stages['heights']) / tri_cnt,
+                memory=get_geom_memory(geom_node) / tri_cnt
+            )
+            self.save_cache(key, calibration)
+
+        self.calibrations[key] = calibration
+        return calibration
+
+    def predict(self, generator, calibration, max_depth, octaves):
+        """Return the predicted time and memory of the generation.
+        """
+        tri_cnt = self.count_triangles(generator, max_depth)
+        t = tri_cnt * (calibration['height_time'] * octaves + calibration['other_time'])
+        memory = tri_cnt * calibration['memory']
+        return t, memory
+
+    def fits(self, predicted_time, predicted_memory):
+        if self.time_budget is not None and predicted_time > self.time_budget:
+            return False
+        if self.memory_budget is not None and predicted_memory > self.memory_budget:
+            return False
+        return True
+
+    def select(self, generator):
+        """Return the highest max_depth, then the most octaves, fitting the budgets,
+           and the predicted time and memory. The lowest quality is returned if nothing fits.
+        """
+        calibration = self.calibrate(generator)
+        octave_range = range(1, self.max_octaves + 1) if self.max_octaves else [generator.octaves]
+        selected = None
+
+        for max_depth in range(1, self.depth_limit + 1):
+            for octaves in octave_range:
+                predicted = self.predict(generator, calibration, max_depth, octaves)
+
+                if selected is None or self.fits(*predicted):
+                    selected = (max_depth, octaves, *predicted)
+
+        return selected
+
+    def create(self, generator):
+        """Create the terrain at the selected quality and keep a BudgetReport
+           of the predicted and actual costs.
+        """
+        max_depth, octaves, predicted_time, predicted_memory = self.select(generator)
+        generator.max_depth = max_depth
+        generator.octaves = octaves
+
+        start = time.perf_counter()
+        model = generator.create()
+        actual_time = time.perf_counter() - start
+
+        self.report = BudgetReport(
+            max_depth, octaves, predicted_time, actual_time,
+            predicted_memory, get_geom_memory(model.node())
+        )
+        return model
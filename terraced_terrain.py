@@ -1,5 +1,7 @@
 import sys
 import math
+import time
+from collections import OrderedDict, deque
 from enum import Enum, auto
 from datetime import datetime
 
@@ -15,8 +17,8 @@ from panda3d.core import OrthographicLens, Camera, MouseWatcher, PGTop
 from panda3d.core import AntialiasAttrib
 
 
-from gui import Gui
-from terraced_terrain_generator import TerracedTerrainGenerator
+from gui import Gui, Overlay
+from terraced_terrain_generator import TerracedTerrainGenerator, GenerationCancelled
 from themes import themes
 
 # Without 'framebuffer-multisample' and 'multisamples' settings,
@@ -72,6 +74,71 @@ class Progress(DirectWaitBar):
         self['value'] += 1
 
 
+class Pregenerator:
+    """Generate the terrains likely to be requested next in a thread while the viewer
+       is idle, and keep them in a bounded LRU cache so that they can be swapped in at once.
+        Args:
+            maxsize (int): the maximum number of terrains kept.
+    """
+
+    def __init__(self, maxsize=6):
+        self.maxsize = maxsize
+        self.terrains = OrderedDict()
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, candidates):
+        """Args:
+            candidates (list): (key, generator) in the order of priority.
+        """
+        self.cancel()
+        # a new event for each run, so that the cancelled run never resumes.
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(candidates, self.cancelled), daemon=True)
+        self.thread.start()
+
+    def run(self, candidates, cancelled):
+        for key, generator in candidates:
+            if cancelled.is_set():
+                break
+
+            with self.lock:
+                if key in self.terrains:
+                    continue
+
+            generator.cancelled = cancelled
+            start = time.perf_counter()
+
+            try:
+                model = generator.create()
+            except GenerationCancelled:
+                break
+
+            with self.lock:
+                self.terrains[key] = (model, time.perf_counter() - start, dict(generator.stage_times))
+
+                while len(self.terrains) > self.maxsize:
+                    _, (evicted, _, _) = self.terrains.popitem(last=False)
+                    evicted.remove_node()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def pop(self, key):
+        """Return (model, generation time, stage times) of the terrain, or None if not generated yet.
+        """
+        with self.lock:
+            if (entry := self.terrains.pop(key, None)) is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return entry
+
+
 class TerracedTerrain(ShowBase):
 
     def __init__(self):
@@ -95,9 +162,18 @@ class TerracedTerrain(ShowBase):
         # create gui.
         self.gui = Gui(self.gui_aspect2d)
         self.gui.create_control_widgets()
+        # create performance overlay.
+        self.overlay = Overlay(self.aspect2d, Point3(-1.15, 0, 0.9))
+        self.generation_history = deque(maxlen=5)
+        self.overlay_update_time = 0
+        # pre-generate the other noises and themes while idle.
+        self.pregenerator = Pregenerator()
+
         # show terrain.
         self.create_model()
         self.model.reparent_to(self.render)
+        self.record_generation()
+        self.start_pregeneration()
 
         self.show_wireframe = False
         self.dragging = False
@@ -106,6 +182,7 @@ class TerracedTerrain(ShowBase):
 
         # self.accept('d', self.toggle_wireframe)
         self.accept('i', self.print_info)
+        self.accept('p', self.toggle_overlay)
         self.accept('escape', sys.exit)
         self.accept('mouse1', self.mouse_click)
         self.accept('mouse1-up', self.mouse_release)
@@ -126,6 +203,76 @@ class TerracedTerrain(ShowBase):
         # self.toggle_wireframe()
         self.show_wireframe = not self.show_wireframe
 
+    def toggle_overlay(self):
+        self.overlay.toggle()
+        self.update_overlay()
+
+    def get_model_stats(self):
+        """Return the numbers of vertices and triangles, and the size of GeomVertexData in bytes.
+        """
+        vertices = triangles = memory = 0
+
+        geom_nps = [self.model] + [np_ for np_ in self.model.find_all_matches('**/+GeomNode')]
+
+        for geom_np in geom_nps:
+            if not (geom_node := geom_np.node()).is_geom_node():
+                continue
+
+            for i in range(geom_node.get_num_geoms()):
+                geom = geom_node.get_geom(i)
+                vdata = geom.get_vertex_data()
+                vertices += vdata.get_num_rows()
+                memory += sum(vdata.get_array(j).get_data_size_bytes() for j in range(vdata.get_num_arrays()))
+                triangles += sum(geom.get_primitive(j).get_num_primitives() for j in range(geom.get_num_primitives()))
+
+        return vertices, triangles, memory
+
+    def is_cython_noise(self):
+        # noise/__init__ falls back to the python code if the cython code is not built.
+        return any(name.startswith('noise.cynoise') for name in sys.modules)
+
+    def record_generation(self):
+        vertices, triangles, memory = self.get_model_stats()
+        self.generation_history.append(dict(
+            noise=self.gui.get_checked_noise(),
+            theme=self.gui.get_checked_theme(),
+            max_depth=self.terrain_generator.max_depth,
+            octaves=self.terrain_generator.octaves,
+            time=self.generation_time,
+            stages=self.generation_stages,
+            source=self.generation_source,
+            vertices=vertices,
+            triangles=triangles,
+            memory=memory
+        ))
+        self.update_overlay()
+
+    def update_overlay(self):
+        if self.overlay.is_hidden() or not self.generation_history:
+            return
+
+        last = self.generation_history[-1]
+        lines = [f'generation  {last["time"]:.3f} s  ({last["source"]})']
+        lines += [f'    {k}  {v:.3f} s' for k, v in last['stages'].items()]
+        lines += [
+            f'vertices  {last["vertices"]:,}',
+            f'triangles  {last["triangles"]:,}',
+            f'vertex data  {last["memory"] / 1024 ** 2:.2f} MB',
+            f'frame  {globalClock.get_average_frame_rate():.1f} fps'
+            f'  ({globalClock.get_dt() * 1000:.1f} ms)',
+            f'cython noise  {"active" if self.is_cython_noise() else "inactive"}',
+            f'pregenerated  {len(self.pregenerator.terrains)}  hits {self.pregenerator.hits}'
+            f'  misses {self.pregenerator.misses}',
+            '',
+            'recent generations'
+        ]
+        lines += [
+            f'    {h["noise"]} {h["theme"]} depth {h["max_depth"]} octaves {h["octaves"]}'
+            f'  {h["time"]:.3f} s  {h["triangles"]:,} tris  {h["source"]}'
+            for h in reversed(self.generation_history)
+        ]
+        self.overlay.set_text(lines)
+
     def print_info(self):
         print(self.camera_root.get_hpr())
 
@@ -279,6 +426,7 @@ class TerracedTerrain(ShowBase):
     def start_terrain_change(self):
         if self.state == Status.DISPLAYING:
             if self.gui.validate_input_values():
+                self.pregenerator.cancel()
                 self.state = Status.REMOVE
 
     def remove_current_terrain(self):
@@ -286,9 +434,39 @@ class TerracedTerrain(ShowBase):
         self.model = None
 
     def create_model(self):
+        start = time.perf_counter()
         self.model = self.terrain_generator.create()
+        self.generation_time = time.perf_counter() - start
+        self.generation_stages = dict(self.terrain_generator.stage_times)
+        self.generation_source = 'generated'
         self.model.set_pos_hpr_scale(Point3(0, 0, 0), Vec3(0, 45, 0), 4)
 
+    def swap_model(self, entry):
+        self.model, generation_time, self.generation_stages = entry
+        self.generation_time = generation_time
+        self.generation_source = 'pregenerated'
+        self.model.set_pos_hpr_scale(Point3(0, 0, 0), Vec3(0, 45, 0), 4)
+
+    def get_terrain_key(self, noise, theme, generator):
+        return (noise, theme, *(getattr(generator, k) for k in self.gui.input_items))
+
+    def start_pregeneration(self):
+        """Pre-generate the other noises with the current theme, then the other themes
+           with the current noise, at the current parameters.
+        """
+        noise, theme = self.gui.get_checked_noise(), self.gui.get_checked_theme()
+        params = {k: getattr(self.terrain_generator, k) for k in self.gui.input_items}
+        combinations = [(n, theme) for n in self.gui.noises if n != noise]
+        combinations += [(noise, t) for t in self.gui.themes if t != theme]
+        candidates = []
+
+        for n, t in combinations:
+            generator = self.get_terrain_generator(n, params, keep_scale=(n == noise))
+            generator.theme = themes[t.lower()]
+            candidates.append((self.get_terrain_key(n, t, generator), generator))
+
+        self.pregenerator.start(candidates)
+
     def change_terrain_attributes(self):
         input_values = self.gui.get_input_values()
 
@@ -299,21 +477,38 @@ class TerracedTerrain(ShowBase):
         theme = themes[theme_name.lower()]
         setattr(self.terrain_generator, "theme", theme)
 
-    def create_terrain_generator(self):
-        noise = self.gui.get_checked_noise()
-
+    def get_terrain_generator(self, noise, params=None, keep_scale=False):
+        """Return a new generator of the noise with the parameters if given.
+           The scale, which suits each noise, is kept at its default unless keep_scale is True.
+        """
         match noise:
             case 'SimplexNoise':
-                self.terrain_generator = TerracedTerrainGenerator.from_simplex()
+                generator = TerracedTerrainGenerator.from_simplex()
 
             case 'CelullarNoise':
-                self.terrain_generator = TerracedTerrainGenerator.from_cellular()
+                generator = TerracedTerrainGenerator.from_cellular()
 
             case 'PerlinNoise':
-                self.terrain_generator = TerracedTerrainGenerator.from_perlin()
+                generator = TerracedTerrainGenerator.from_perlin()
 
             case 'SimplexFractalNoise':
-                self.terrain_generator = TerracedTerrainGenerator.from_fractal()
+                generator = TerracedTerrainGenerator.from_fractal()
+
+        for k, v in (params or {}).items():
+            if k != 'scale' or keep_scale:
+                setattr(generator, k, v)
+
+        return generator
+
+    def create_terrain_generator(self):
+        noise = self.gui.get_checked_noise()
+        params = None
+
+        # keep the current parameters so that the pre-generated terrain can be used.
+        if (current := getattr(self, 'terrain_generator', None)) is not None:
+            params = {k: getattr(current, k) for k in self.gui.input_items}
+
+        self.terrain_generator = self.get_terrain_generator(noise, params)
 
         default_values = {k: getattr(self.terrain_generator, k) for k in self.gui.input_items.keys()}
         self.gui.set_input_values(default_values)
@@ -324,6 +519,9 @@ class TerracedTerrain(ShowBase):
         match self.state:
 
             case Status.DISPLAYING:
+                if (now := globalClock.get_frame_time()) - self.overlay_update_time >= 0.5:
+                    self.overlay_update_time = now
+                    self.update_overlay()
 
                 if self.mw3d_node.has_mouse():
                     mouse_pos = self.mw3d_node.get_mouse()
@@ -339,10 +537,17 @@ class TerracedTerrain(ShowBase):
 
             case Status.SETUP:
                 self.change_terrain_attributes()
-                self.bar = Progress(self.aspect2d)
-                self.terrain_create_thread = threading.Thread(target=self.create_model)
-                self.terrain_create_thread.start()
-                self.state = Status.CREATE
+                key = self.get_terrain_key(
+                    self.gui.get_checked_noise(), self.gui.get_checked_theme(), self.terrain_generator)
+
+                if (entry := self.pregenerator.pop(key)) is not None:
+                    self.swap_model(entry)
+                    self.state = Status.FINISH
+                else:
+                    self.bar = Progress(self.aspect2d)
+                    self.terrain_create_thread = threading.Thread(target=self.create_model)
+                    self.terrain_create_thread.start()
+                    self.state = Status.CREATE
 
             case Status.CREATE:
                 if not self.terrain_create_thread.is_alive():
@@ -358,7 +563,9 @@ class TerracedTerrain(ShowBase):
             case Status.FINISH:
                 self.model.reparent_to(self.render)
                 self.camera_root.set_hpr(self.default_hpr)
+                self.record_generation()
                 self.gui.enable_buttons()
+                self.start_pregeneration()
                 self.state = Status.DISPLAYING
 
         return task.cont
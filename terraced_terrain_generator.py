@@ -1,16 +1,29 @@
 import array
 import math
 import random
+import time
+from collections import namedtuple
 
-import numpy as np
 from panda3d.core import Vec3, Point3, Vec2
+from panda3d.core import LODNode, NodePath
 
 from shapes.create_geometry import ProceduralGeometry
-from noise import SimplexNoise, PerlinNoise, CellularNoise
-from noise import Fractal2D
+from lattice import Lattice, LatticeCache
+from octave_cache import OctaveCache
 from themes import themes, Island
 
-from mask.radial_gradient_generator import RadialGradientMask
+# The noise, the mask (which depends on OpenCV) and the modules depending on numpy
+# are imported on first use to keep importing this module fast.
+
+
+# A detail level of LODNode. The level is displayed while the distance from
+# the camera is between near and far; terrace_height of None keeps the generator's one.
+LodLevel = namedtuple('LodLevel', 'max_depth far near terrace_height', defaults=[None])
+
+
+class GenerationCancelled(Exception):
+    """Raised when the event set to TerracedTerrainGenerator.cancelled is set during the generation.
+    """
 
 
 class TerracedTerrainGenerator(ProceduralGeometry):
@@ -24,10 +37,17 @@ class TerracedTerrainGenerator(ProceduralGeometry):
                              vertex of the polygon that forms the ground, are further divided into triangles.
             octaves (int): The number of loops to calculate the height of the vertex coordinates.
             theme (str): one of "mountain", "snowmountain" and "desert".
+            seed (int): seed for the noise offsets; if None, a different terrain is generated every time.
     """
 
+    # the subdivided triangles, shared by the generators of the same polygon and max_depth.
+    lattice_cache = LatticeCache()
+    # the noise of each octave at the vertices of a lattice, reused when only octaves
+    # or persistence are changed; used only if seed is given.
+    octave_cache = OctaveCache()
+
     def __init__(self, noise, scale=10, segs_c=5, radius=4,
-                 max_depth=6, octaves=6, theme='mountain'):
+                 max_depth=6, octaves=6, theme='mountain', seed=None):
         super().__init__()
         self.center = Point3(0, 0, 0)
         self.noise = noise
@@ -37,31 +57,50 @@ class TerracedTerrainGenerator(ProceduralGeometry):
         self.max_depth = max_depth
         self.octaves = octaves
         self.theme = themes.get(theme.lower())
+        self.seed = seed
+        self.terrace_height = 0.05
+        self.frequency = 0.055
+        self.persistence = 0.375  # 0.5
+        self.lacunarity = 2.52    # 2.5
+        self.height_cache = None
+        self.vertex_layout = None
+        self.optimize_vertex_cache = False
+        self.optimization_report = None
+        self.stage_times = {}
+        self.budget_report = None
+        self.build_height_index = False
+        self.height_index = None
+        # an event (threading.Event) to stop the generation from another thread.
+        self.cancelled = None
 
     @classmethod
     def from_simplex(cls, scale=8, segs_c=5, radius=3,
-                     max_depth=6, octaves=3, theme='mountain'):
+                     max_depth=6, octaves=3, theme='mountain', seed=None):
+        from noise import SimplexNoise
         noise = SimplexNoise()
-        return cls(noise.snoise2, scale, segs_c, radius, max_depth, octaves, theme)
+        return cls(noise.snoise2, scale, segs_c, radius, max_depth, octaves, theme, seed)
 
     @classmethod
     def from_perlin(cls, scale=15, segs_c=5, radius=3,
-                    max_depth=6, octaves=3, theme='mountain'):
+                    max_depth=6, octaves=3, theme='mountain', seed=None):
+        from noise import PerlinNoise
         noise = PerlinNoise()
-        return cls(noise.pnoise2, scale, segs_c, radius, max_depth, octaves, theme)
+        return cls(noise.pnoise2, scale, segs_c, radius, max_depth, octaves, theme, seed)
 
     @classmethod
     def from_cellular(cls, scale=10, segs_c=5, radius=3,
-                      max_depth=6, octaves=3, theme='mountain'):
+                      max_depth=6, octaves=3, theme='mountain', seed=None):
+        from noise import CellularNoise
         noise = CellularNoise()
-        return cls(noise.fdist2, scale, segs_c, radius, max_depth, octaves, theme)
+        return cls(noise.fdist2, scale, segs_c, radius, max_depth, octaves, theme, seed)
 
     @classmethod
     def from_fractal(cls, scale=10, segs_c=5, radius=3,
-                     max_depth=6, octaves=3, theme='island'):
+                     max_depth=6, octaves=3, theme='island', seed=None):
+        from noise import SimplexNoise, Fractal2D
         simplex = SimplexNoise()
         noise = Fractal2D(simplex.snoise2)
-        return cls(noise.fractal, scale, segs_c, radius, max_depth, octaves, theme)
+        return cls(noise.fractal, scale, segs_c, radius, max_depth, octaves, theme, seed)
 
     def get_polygon_vertices(self, theta):
         rad = math.radians(theta)
@@ -109,9 +148,7 @@ class TerracedTerrainGenerator(ProceduralGeometry):
     def get_height(self, x, y, t, offsets):
         height = 0
         amplitude = 1.0
-        frequency = 0.055
-        persistence = 0.375  # 0.5
-        lacunarity = 2.52    # 2.5
+        frequency = self.frequency
 
         for i in range(self.octaves):
             offset = offsets[i]
@@ -120,9 +157,14 @@ class TerracedTerrainGenerator(ProceduralGeometry):
             noise = self.noise((fx + t) * self.scale, (fy + t) * self.scale)
 
             height += amplitude * noise
-            frequency *= lacunarity
-            amplitude *= persistence
+            frequency *= self.lacunarity
+            amplitude *= self.persistence
 
+        return self.adjust_height(x, y, height)
+
+    def adjust_height(self, x, y, height):
+        """Apply the mask of the island or the lowest threshold of the theme to the sum of the octaves.
+        """
         if self.theme == Island:
             r, _, _ = self.mask.get_gradient(x, y)
             height = 0 if r >= height else height - r
@@ -132,135 +174,290 @@ class TerracedTerrainGenerator(ProceduralGeometry):
 
         return height
 
-    def generate_hills_and_valleys(self):
-        t = random.uniform(0, 1000)
-        offsets = [Vec2(random.randint(-1000, 1000),
-                        random.randint(-1000, 1000)) for _ in range(self.octaves)]
+    def get_noise_domain(self):
+        """Return the time offset and the per-octave offsets in the noise domain.
+           The same seed always gives the same values, so that separately
+           generated pieces of terrain share one continuous height field.
+        """
+        rand = random.Random(self.seed)
+        t = rand.uniform(0, 1000)
+        offsets = [Vec2(rand.randint(-1000, 1000),
+                        rand.randint(-1000, 1000)) for _ in range(self.octaves)]
 
+        return t, offsets
+
+    def generate_subdivided_triangles(self):
         for pt1, pt2 in self.generate_basic_polygon():
-            for tri in self.generate_triangles([pt1, pt2, self.center]):
+            yield from self.generate_triangles([pt1, pt2, self.center])
+
+    def get_lattice_key(self):
+        """Return the key of the lattice cache; generators of the same key share a lattice.
+        """
+        return (type(self).__qualname__, self.segs_c, self.radius,
+                self.max_depth, self.center.x, self.center.y)
+
+    def create_lattice(self):
+        return Lattice.from_triangles(self.watch_cancel(self.generate_subdivided_triangles()))
+
+    def watch_cancel(self, iterable, interval=256):
+        """Yield the items, raising GenerationCancelled once the event of cancelled is set.
+           The event is checked every interval items.
+        """
+        if self.cancelled is None:
+            yield from iterable
+            return
+
+        for i, item in enumerate(iterable):
+            if i % interval == 0 and self.cancelled.is_set():
+                raise GenerationCancelled('The generation was cancelled.')
+            yield item
+
+    def get_lattice_points(self, lattice):
+        """Return x and y of the vertices of the lattice placed on this terrain.
+           The lattice is built at the place of the terrain, so they are returned as they are.
+        """
+        return lattice.xs, lattice.ys
+
+    def get_lattice_heights(self, lattice, t, offsets):
+        """Calculate the height of each vertex of the lattice.
+        """
+        xs, ys = self.get_lattice_points(lattice)
+
+        if self.height_cache is None:
+            if self.octave_cache is not None and self.seed is not None:
+                return self.sum_octaves(lattice, xs, ys, t, offsets)
+            return [self.get_height(x, y, t, offsets) for x, y in self.watch_cancel(zip(xs, ys))]
+
+        heights = []
+
+        for key in self.watch_cancel(zip(xs, ys)):
+            if (z := self.height_cache.get(key)) is None:
+                z = self.height_cache[key] = self.get_height(*key, t, offsets)
+            heights.append(z)
+
+        return heights
+
+    def sum_octaves(self, lattice, xs, ys, t, offsets):
+        """Calculate the height of each vertex of the lattice from the cached noise of each octave.
+        """
+        heights = [0] * len(xs)
+        amplitude = 1.0
+        frequency = self.frequency
+
+        for i in range(self.octaves):
+            values = self.octave_cache.get(self, lattice, xs, ys, t, offsets[i], frequency)
+            heights = [h + amplitude * v for h, v in zip(heights, values)]
+            frequency *= self.lacunarity
+            amplitude *= self.persistence
+
+        return [self.adjust_height(x, y, h) for x, y, h in self.watch_cancel(zip(xs, ys, heights))]
+
+    def generate_hills_and_valleys(self, use_lattice=True):
+        """Args:
+            use_lattice (bool): if False, the triangles are subdivided on the fly instead of
+                                using the cached lattice, so that the whole lattice is never held.
+        """
+        t, offsets = self.get_noise_domain()
+
+        if not use_lattice:
+            for tri in self.watch_cancel(self.generate_subdivided_triangles()):
                 for vert in tri:
-                    z = self.get_height(vert.x, vert.y, t, offsets)
-                    vert.z = z
+                    vert.z = self.get_height(vert.x, vert.y, t, offsets)
                 yield tri
+            return
+
+        # the subdivided triangles are reused from the cache; only the heights are calculated.
+        lattice = self.lattice_cache.get(self)
+        heights = self.get_lattice_heights(lattice, t, offsets)
+        xs, ys = self.get_lattice_points(lattice)
+
+        for tri in lattice.iter_triangles():
+            yield [Point3(xs[i], ys[i], heights[i]) for i in tri]
 
-    def generate_terraced_terrain(self, vertex_cnt, vdata_values, prim_indices):
+    def setup_mask(self):
         if self.theme == Island:
+            from mask.radial_gradient_generator import RadialGradientMask
             self.mask = RadialGradientMask(
                 height=self.radius, width=self.radius, center_h=0, center_w=0)
 
-        for v1, v2, v3 in self.generate_hills_and_valleys():
-            # Each point's heights above "sea level". For a flat terrain,
-            # it's just the vertical component of the respective vector.
-            h1 = v1.z
-            h2 = v2.z
-            h3 = v3.z
-
-            li = [int(h_ * 10) for h_ in (h1, h2, h3)]
-            h_min = np.floor(min(li))
-            h_max = np.floor(max(li))
-
-            for h in np.arange(h_min, h_max + 1, 0.5):
-                # indicate triangles above the plane.
-                h *= 0.1
-                points_above = 0
-
-                if h1 < h:
-                    if h2 < h:
-                        if h3 >= h:
-                            points_above = 1          # v3 is above.
+    def generate_terraced_terrain(self, vertex_cnt, vdata_values, prim_indices, prim_levels=None):
+        """Slice the triangles of the hills and valleys into terraces.
+            Args:
+                vertex_cnt (int): the number of vertices already written.
+                vdata_values (array.array): vertex data is appended to this.
+                prim_indices (array.array): vertex indices are appended to this.
+                prim_levels (array.array): if given, the terrace level of each triangle is appended.
+        """
+        self.setup_mask()
+        start = time.perf_counter()
+        terrace_time = 0
+
+        for v1, v2, v3 in self.watch_cancel(self.generate_hills_and_valleys()):
+            terrace_start = time.perf_counter()
+            vertex_cnt = self.create_terraces(
+                v1, v2, v3, vertex_cnt, vdata_values, prim_indices, prim_levels)
+            terrace_time += time.perf_counter() - terrace_start
+
+        # the time of the hills and valleys includes the subdivision of the triangles.
+        self.stage_times['heights'] = time.perf_counter() - start - terrace_time
+        self.stage_times['terraces'] = terrace_time
+
+        return vertex_cnt
+
+    def generate_mesh_chunks(self, max_vertices=65536):
+        """Generate the terrain as TerrainMesh chunks, each of which has about max_vertices
+           vertices, so that the whole terrain never has to be held in memory.
+        """
+        from terrain_mesh import TerrainMesh
+
+        self.setup_mask()
+        vdata_values = array.array('f', [])
+        prim_indices = array.array('I', [])
+        prim_levels = array.array('i', [])
+        vertex_cnt = 0
+
+        for v1, v2, v3 in self.generate_hills_and_valleys(use_lattice=False):
+            vertex_cnt = self.create_terraces(
+                v1, v2, v3, vertex_cnt, vdata_values, prim_indices, prim_levels)
+
+            if vertex_cnt >= max_vertices:
+                yield TerrainMesh.from_buffers(vdata_values, prim_indices, prim_levels)
+                vdata_values = array.array('f', [])
+                prim_indices = array.array('I', [])
+                prim_levels = array.array('i', [])
+                vertex_cnt = 0
+
+        if vertex_cnt > 0:
+            yield TerrainMesh.from_buffers(vdata_values, prim_indices, prim_levels)
+
+    def create_terraces(self, v1, v2, v3, vertex_cnt, vdata_values, prim_indices, prim_levels=None):
+        """Slice a triangle of the hills and valleys by the planes of the terraces,
+           and return the number of vertices after adding the roofs and walls.
+        """
+        # Each point's heights above "sea level". For a flat terrain,
+        # it's just the vertical component of the respective vector.
+        h1 = v1.z
+        h2 = v2.z
+        h3 = v3.z
+
+        # planes are put at every terrace_height.
+        span = self.terrace_height * 2
+        li = [int(h_ / span) for h_ in (h1, h2, h3)]
+        h_min = min(li)
+        h_max = max(li)
+        wall_normal = self.calc_wall_normal(v1, v2, v3)
+
+        for i in range((h_max - h_min + 1) * 2):
+            # indicate triangles above the plane.
+            h = (h_min + i * 0.5) * span
+            level = round(h / self.terrace_height)
+            points_above = 0
+
+            if h1 < h:
+                if h2 < h:
+                    if h3 >= h:
+                        points_above = 1          # v3 is above.
+                else:
+                    if h3 < h:
+                        points_above = 1          # v2 is above.
+                        v1, v2, v3 = v3, v1, v2
+                    else:
+                        points_above = 2          # v2 and v3 are above.
+                        v1, v2, v3 = v2, v3, v1
+            else:
+                if h2 < h:
+                    if h3 < h:
+                        points_above = 1          # v1 is above.
+                        v1, v2, v3 = v2, v3, v1
                     else:
-                        if h3 < h:
-                            points_above = 1          # v2 is above.
-                            v1, v2, v3 = v3, v1, v2
-                        else:
-                            points_above = 2          # v2 and v3 are above.
-                            v1, v2, v3 = v2, v3, v1
+                        points_above = 2          # v1 and v3 are above.
+                        v1, v2, v3 = v3, v1, v2
                 else:
-                    if h2 < h:
-                        if h3 < h:
-                            points_above = 1          # v1 is above.
-                            v1, v2, v3 = v2, v3, v1
-                        else:
-                            points_above = 2          # v1 and v3 are above.
-                            v1, v2, v3 = v3, v1, v2
+                    if h3 < h:
+                        points_above = 2          # v1 and v2 are above.
                     else:
-                        if h3 < h:
-                            points_above = 2          # v1 and v2 are above.
-                        else:
-                            points_above = 3          # all vectors are above.
-
-                h1, h2, h3 = v1.z, v2.z, v3.z
-                # for each point of the triangle, we also need its projections
-                # to the current plane and the plane below. Just set its vertical component to the plane's height.
-
-                # current plane
-                v1_c = Point3(v1.x, v1.y, h)
-                v2_c = Point3(v2.x, v2.y, h)
-                v3_c = Point3(v3.x, v3.y, h)
-
-                # generate mesh polygons for each of the three cases.
-                if points_above == 3:
-                    # add one triangle.
-                    color = self.theme.color(v1_c.z)
-                    self.create_triangle_vertices([v1_c, v2_c, v3_c], color, vdata_values)
-                    prim_indices.extend([vertex_cnt, vertex_cnt + 1, vertex_cnt + 2])
-                    vertex_cnt += 3
-                    continue
-
-                # the plane below; used to make vertical walls between planes.
-                v1_b = Point3(v1.x, v1.y, h - 0.05)
-                v2_b = Point3(v2.x, v2.y, h - 0.05)
-                v3_b = Point3(v3.x, v3.y, h - 0.05)
-
-                # find locations of new points that are located on the sides of the triangle's projections,
-                # by interpolating between vectors based on their heights.
-
-                # interpolation value for v1 and v3
-                # h is np.float64. if h1 - h3 == 0, t1 becomes -inf.
-                t1 = 0 if (denom := h1 - h3) == 0 else (h1 - h) / denom
-                # t1 = (h1 - h) / (h1 - h3)
-                v1_c_n = self.lerp(v1_c, v3_c, t1)
-                v1_b_n = self.lerp(v1_b, v3_b, t1)
-
-                # interpolation value for v2 and v3
-                # h is np.float64. if h2 - h3 == 0, t2 becomes -inf.
-                t2 = 0 if (denom := h2 - h3) == 0 else (h2 - h) / denom
-                # t2 = (h2 - h) / (h2 - h3)
-                v2_c_n = self.lerp(v2_c, v3_c, t2)
-                v2_b_n = self.lerp(v2_b, v3_b, t2)
-
-                if points_above == 2:
-                    color = self.theme.color(v1_c.z)
-                    # add roof part of the step
-                    quad = [v1_c, v2_c, v2_c_n, v1_c_n]
-                    self.create_quad_vertices(quad, color, vdata_values, wall=False)
-                    prim_indices.extend([vertex_cnt, vertex_cnt + 1, vertex_cnt + 2])
-                    prim_indices.extend([vertex_cnt + 2, vertex_cnt + 3, vertex_cnt])
-                    vertex_cnt += 4
-
-                    # add wall part of the step
-                    quad = [v1_c_n, v2_c_n, v2_b_n, v1_b_n]
-                    self.create_quad_vertices(quad, color, vdata_values, wall=True)
-                    prim_indices.extend([vertex_cnt, vertex_cnt + 1, vertex_cnt + 2])
-                    prim_indices.extend([vertex_cnt, vertex_cnt + 2, vertex_cnt + 3])
-                    vertex_cnt += 4
-
-                elif points_above == 1:
-                    color = self.theme.color(v3_c.z)
-                    # add roof part of the step
-                    self.create_triangle_vertices([v3_c, v1_c_n, v2_c_n], color, vdata_values)
-
-                    # self.create_triangle_vertices(tri, vdata_values)
-                    prim_indices.extend([vertex_cnt, vertex_cnt + 1, vertex_cnt + 2])
-                    vertex_cnt += 3
-
-                    # add wall part of the step
-                    quad = [v2_c_n, v1_c_n, v1_b_n, v2_b_n]
-                    self.create_quad_vertices(quad, color, vdata_values, wall=True)
-                    prim_indices.extend([vertex_cnt, vertex_cnt + 1, vertex_cnt + 3])
-                    prim_indices.extend([vertex_cnt + 1, vertex_cnt + 2, vertex_cnt + 3])
-                    vertex_cnt += 4
+                        points_above = 3          # all vectors are above.
+
+            h1, h2, h3 = v1.z, v2.z, v3.z
+            # for each point of the triangle, we also need its projections
+            # to the current plane and the plane below. Just set its vertical component to the plane's height.
+
+            # current plane
+            v1_c = Point3(v1.x, v1.y, h)
+            v2_c = Point3(v2.x, v2.y, h)
+            v3_c = Point3(v3.x, v3.y, h)
+
+            # generate mesh polygons for each of the three cases.
+            if points_above == 3:
+                # add one triangle.
+                color = self.theme.color(v1_c.z)
+                self.create_triangle_vertices([v1_c, v2_c, v3_c], color, vdata_values)
+                prim_indices.extend([vertex_cnt, vertex_cnt + 1, vertex_cnt + 2])
+                vertex_cnt += 3
+
+                if prim_levels is not None:
+                    prim_levels.append(level)
+                continue
+
+            # the plane below; used to make vertical walls between planes.
+            v1_b = Point3(v1.x, v1.y, h - self.terrace_height)
+            v2_b = Point3(v2.x, v2.y, h - self.terrace_height)
+            v3_b = Point3(v3.x, v3.y, h - self.terrace_height)
+
+            # find locations of new points that are located on the sides of the triangle's projections,
+            # by interpolating between vectors based on their heights.
+
+            # interpolation value for v1 and v3
+            # if h1 - h3 == 0, ZeroDivisionError occurs.
+            t1 = 0 if (denom := h1 - h3) == 0 else (h1 - h) / denom
+            # t1 = (h1 - h) / (h1 - h3)
+            v1_c_n = self.lerp(v1_c, v3_c, t1)
+            v1_b_n = self.lerp(v1_b, v3_b, t1)
+
+            # interpolation value for v2 and v3
+            # if h2 - h3 == 0, ZeroDivisionError occurs.
+            t2 = 0 if (denom := h2 - h3) == 0 else (h2 - h) / denom
+            # t2 = (h2 - h) / (h2 - h3)
+            v2_c_n = self.lerp(v2_c, v3_c, t2)
+            v2_b_n = self.lerp(v2_b, v3_b, t2)
+
+            if points_above == 2:
+                color = self.theme.color(v1_c.z)
+                # add roof part of the step
+                quad = [v1_c, v2_c, v2_c_n, v1_c_n]
+                self.create_quad_vertices(quad, color, vdata_values)
+                prim_indices.extend([vertex_cnt, vertex_cnt + 1, vertex_cnt + 2])
+                prim_indices.extend([vertex_cnt + 2, vertex_cnt + 3, vertex_cnt])
+                vertex_cnt += 4
+
+                # add wall part of the step
+                quad = [v1_c_n, v2_c_n, v2_b_n, v1_b_n]
+                self.create_quad_vertices(quad, color, vdata_values, wall_normal)
+                prim_indices.extend([vertex_cnt, vertex_cnt + 1, vertex_cnt + 2])
+                prim_indices.extend([vertex_cnt, vertex_cnt + 2, vertex_cnt + 3])
+                vertex_cnt += 4
+
+                if prim_levels is not None:
+                    prim_levels.extend([level] * 4)
+
+            elif points_above == 1:
+                color = self.theme.color(v3_c.z)
+                # add roof part of the step
+                self.create_triangle_vertices([v3_c, v1_c_n, v2_c_n], color, vdata_values)
+
+                # self.create_triangle_vertices(tri, vdata_values)
+                prim_indices.extend([vertex_cnt, vertex_cnt + 1, vertex_cnt + 2])
+                vertex_cnt += 3
+
+                # add wall part of the step
+                quad = [v2_c_n, v1_c_n, v1_b_n, v2_b_n]
+                self.create_quad_vertices(quad, color, vdata_values, wall_normal)
+                prim_indices.extend([vertex_cnt, vertex_cnt + 1, vertex_cnt + 3])
+                prim_indices.extend([vertex_cnt + 1, vertex_cnt + 2, vertex_cnt + 3])
+                vertex_cnt += 4
+
+                if prim_levels is not None:
+                    prim_levels.extend([level] * 3)
 
         return vertex_cnt
 
@@ -274,13 +471,27 @@ class TerracedTerrainGenerator(ProceduralGeometry):
             u, v = self.calc_uv(vert.x, vert.y)
             vdata_values.extend((u, v))
 
-    def create_quad_vertices(self, quad, color, vdata_values, wall=False):
-        normal = Vec3(0, 0, 1)
+    def calc_wall_normal(self, v1, v2, v3):
+        """Return the horizontal normal of the walls cut from a triangle; its downhill direction,
+           which is perpendicular to the cut edges and faces their lower side. It depends only on
+           the triangle, so the walls crossing the border of tiles get the same normal on both tiles,
+           and it is defined even if a vertex is on the plane and the cut edge has no length.
+        """
+        normal = (v2 - v1).cross(v3 - v1)
 
-        for vert in quad:
-            if wall:
-                normal = Vec3(vert.x, vert.y, 0).normalized()
+        if normal.z < 0:
+            normal = -normal
+
+        return Vec3(normal.x, normal.y, 0).normalized()
 
+    def create_quad_vertices(self, quad, color, vdata_values, normal=None):
+        """Args:
+            normal (Vec3): the normal of the wall; None for a roof.
+        """
+        if normal is None:
+            normal = Vec3(0, 0, 1)
+
+        for vert in quad:
             vdata_values.extend(vert)
             vdata_values.extend(color)
             vdata_values.extend(normal)
@@ -288,8 +499,8 @@ class TerracedTerrainGenerator(ProceduralGeometry):
             vdata_values.extend((u, v))
 
     def calc_uv(self, x, y):
-        u = 0.5 + x / self.radius * 0.5
-        v = 0.5 + y / self.radius * 0.5
+        u = 0.5 + (x - self.center.x) / self.radius * 0.5
+        v = 0.5 + (y - self.center.y) / self.radius * 0.5
         return u, v
 
     def lerp(self, start, end, t):
@@ -300,14 +511,122 @@ class TerracedTerrainGenerator(ProceduralGeometry):
         """
         return start + (end - start) * t
 
+    def create_geom_node(self, vertex_cnt, vdata_values, prim_indices, name='geom_node'):
+        if self.vertex_layout is None and not self.optimize_vertex_cache:
+            return super().create_geom_node(vertex_cnt, vdata_values, prim_indices, name)
+
+        from terrain_mesh import TerrainMesh, VertexLayout
+        mesh = TerrainMesh.from_buffers(vdata_values, prim_indices)
+
+        if self.optimize_vertex_cache:
+            from mesh_optimizer import VertexCacheOptimizer
+            mesh, self.optimization_report = VertexCacheOptimizer().optimize(mesh)
+
+        return mesh.to_geom_node(name, self.vertex_layout or VertexLayout.STANDARD)
+
     def get_geom_node(self):
         vdata_values = array.array('f', [])
         prim_indices = array.array('I', [])
+        prim_levels = array.array('i', []) if self.build_height_index else None
         vertex_cnt = 0
+        self.stage_times = {}
+
+        vertex_cnt += self.generate_terraced_terrain(vertex_cnt, vdata_values, prim_indices, prim_levels)
+
+        if self.build_height_index:
+            from height_index import HeightIndex
+            from terrain_mesh import TerrainMesh
+            start = time.perf_counter()
+            # the cells are as large as the smallest triangles of the subdivision.
+            mesh = TerrainMesh.from_buffers(vdata_values, prim_indices, prim_levels)
+            self.height_index = HeightIndex(mesh, self.radius / 2 ** (self.max_depth - 1))
+            self.stage_times['height_index'] = time.perf_counter() - start
 
-        vertex_cnt += self.generate_terraced_terrain(vertex_cnt, vdata_values, prim_indices)
         # create a geom node.
+        start = time.perf_counter()
         geom_node = self.create_geom_node(
             vertex_cnt, vdata_values, prim_indices, 'terraced_terrain')
+        self.stage_times['geom_node'] = time.perf_counter() - start
+
+        return geom_node
+
+    def create_within_budget(self, time_budget=None, memory_budget=None, max_octaves=None):
+        """Create the terrain at the highest max_depth, and the most octaves if max_octaves
+           is given, predicted to fit the budgets. max_depth and octaves are overwritten,
+           and budget_report shows the selected values and the predicted and actual costs.
+           Raise ValueError if neither time_budget nor memory_budget is given.
+            Args:
+                time_budget (float): seconds allowed for the generation.
+                memory_budget (int): bytes allowed for the vertex data and indices.
+                max_octaves (int): the upper limit of octaves; if None, octaves is not changed.
+        """
+        from quality_budget import QualityBudget
+
+        budget = QualityBudget(time_budget, memory_budget, max_octaves)
+        model = budget.create(self)
+        self.budget_report = budget.report
+
+        return model
+
+    def get_collision_mesh(self, cell_size=None):
+        """Return a CollisionMesh of the terrain created last. build_height_index
+           must be True when the terrain is created.
+            Args:
+                cell_size (float): length of a side of a cell of the collision heightfield;
+                                   if None, radius / 32.
+        """
+        from collision_mesh import CollisionMesh
+
+        if self.height_index is None:
+            raise RuntimeError('Set build_height_index to True before creating the terrain.')
 
-        return geom_node
\ No newline at end of file
+        if cell_size is None:
+            cell_size = self.radius / 32
+
+        return CollisionMesh.from_height_index(self.height_index, cell_size)
+
+    def get_mesh(self):
+        """Generate the terrain as a TerrainMesh, which does not depend on Panda3D objects.
+        """
+        from terrain_mesh import TerrainMesh
+
+        vdata_values = array.array('f', [])
+        prim_indices = array.array('I', [])
+        prim_levels = array.array('i', [])
+        self.generate_terraced_terrain(0, vdata_values, prim_indices, prim_levels)
+
+        return TerrainMesh.from_buffers(vdata_values, prim_indices, prim_levels)
+
+    def create(self, lod_levels=None):
+        """Return the NodePath of the terrain. If lod_levels is given, the terrain
+           is built for each level and the levels are put under a LODNode.
+           All levels share the noise offsets and the heights of common vertices.
+            Args:
+                lod_levels (list): LodLevel; e.g. [LodLevel(6, 50, 0), LodLevel(4, 200, 50)]
+        """
+        if not lod_levels:
+            return super().create()
+
+        org_seed, org_depth, org_terrace = self.seed, self.max_depth, self.terrace_height
+        lod_node = LODNode('terraced_terrain_lod')
+        lod_np = NodePath(lod_node)
+
+        if self.seed is None:
+            self.seed = random.randint(0, 2 ** 31 - 1)
+        self.height_cache = {}
+
+        try:
+            for level in lod_levels:
+                self.max_depth = level.max_depth
+                if level.terrace_height is not None:
+                    self.terrace_height = level.terrace_height
+
+                model = super().create()
+                model.reparent_to(lod_np)
+                lod_node.add_switch(level.far, level.near)
+                self.terrace_height = org_terrace
+        finally:
+            self.seed, self.max_depth, self.terrace_height = org_seed, org_depth, org_terrace
+            self.height_cache = None
+
+        return lod_np
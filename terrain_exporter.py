@@ -0,0 +1,299 @@
+import gzip
+import pathlib
+import queue
+import struct
+import threading
+import zlib
+
+import numpy as np
+from panda3d.core import BamFile, Filename, NodePath
+
+from terrain_mesh import TerrainMesh, VertexLayout
+
+
+class MeshFileWriter:
+    """Base class of the writers which receive TerrainMesh chunks one by one.
+        Args:
+            filename (str): the path of the output file.
+            compress (bool): if True, the output is compressed.
+    """
+
+    def __init__(self, filename, compress=False):
+        self.filename = filename
+        self.compress = compress
+
+    def write(self, mesh):
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+
+class BinaryMeshWriter(MeshFileWriter):
+    """Write chunks into an indexed binary file.
+       The file consists of the header, the chunks made by TerrainMesh.to_bytes
+       (compressed by zlib if required), the index of the chunks and the footer.
+    """
+
+    magic = b'TTRF'
+    version = 1
+    header = struct.Struct('<4sHH')          # magic, version, flags
+    index_entry = struct.Struct('<QQII')     # offset, size, vertices, triangles
+    footer = struct.Struct('<QI4s')          # index offset, chunks, magic
+    zlib_flag = 1
+
+    def __init__(self, filename, compress=False):
+        super().__init__(filename, compress)
+        self.index = []
+        self.file = open(filename, 'wb')
+        flags = self.zlib_flag if compress else 0
+        self.file.write(self.header.pack(self.magic, self.version, flags))
+
+    def write(self, mesh):
+        data = mesh.to_bytes()
+        if self.compress:
+            data = zlib.compress(data)
+
+        self.index.append((self.file.tell(), len(data), mesh.num_vertices, mesh.num_triangles))
+        self.file.write(data)
+
+    def close(self):
+        index_offset = self.file.tell()
+
+        for entry in self.index:
+            self.file.write(self.index_entry.pack(*entry))
+
+        self.file.write(self.footer.pack(index_offset, len(self.index), self.magic))
+        self.file.close()
+
+
+class BinaryMeshReader:
+    """Read the chunks of a file written by BinaryMeshWriter.
+       Any chunk can be read without reading the others.
+        Args:
+            filename (str): the path of the file.
+    """
+
+    def __init__(self, filename):
+        w = BinaryMeshWriter
+        self.file = open(filename, 'rb')
+        magic, _, flags = w.header.unpack(self.file.read(w.header.size))
+
+        if magic != w.magic:
+            raise ValueError(f'{filename} is not a terrain mesh file.')
+        self.compressed = bool(flags & w.zlib_flag)
+
+        self.file.seek(-w.footer.size, 2)
+        index_offset, cnt, _ = w.footer.unpack(self.file.read(w.footer.size))
+        self.file.seek(index_offset)
+        data = self.file.read(w.index_entry.size * cnt)
+        self.index = [e for e in w.index_entry.iter_unpack(data)]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for i in range(len(self.index)):
+            yield self.read_chunk(i)
+
+    def read_chunk(self, i):
+        offset, size, _, _ = self.index[i]
+        self.file.seek(offset)
+        data = self.file.read(size)
+
+        if self.compressed:
+            data = zlib.decompress(data)
+        return TerrainMesh.from_bytes(data)
+
+    def close(self):
+        self.file.close()
+
+
+class ObjWriter(MeshFileWriter):
+    """Write chunks into a Wavefront OBJ file. The vertex colors are written
+       after the positions. If compress is True, the file is gzipped.
+    """
+
+    def __init__(self, filename, compress=False):
+        super().__init__(filename, compress)
+        self.vertex_cnt = 0
+
+        if compress:
+            self.file = gzip.open(filename, 'wt', encoding='ascii')
+        else:
+            self.file = open(filename, 'w', encoding='ascii')
+
+    def write(self, mesh):
+        v = np.hstack([mesh.positions, mesh.colors[:, :3]])
+        np.savetxt(self.file, v, fmt='v %.6f %.6f %.6f %.4f %.4f %.4f')
+        np.savetxt(self.file, mesh.normals, fmt='vn %.4f %.4f %.4f')
+        np.savetxt(self.file, mesh.uvs, fmt='vt %.6f %.6f')
+
+        # obj indices start from 1.
+        faces = np.repeat(mesh.indices.astype(np.int64) + self.vertex_cnt + 1, 3, axis=1)
+        np.savetxt(self.file, faces, fmt='f %d/%d/%d %d/%d/%d %d/%d/%d')
+        self.vertex_cnt += mesh.num_vertices
+
+    def close(self):
+        self.file.close()
+
+
+class BamWriter(MeshFileWriter):
+    """Write each chunk as a GeomNode into a bam file as soon as it arrives.
+       Because the file has one object per chunk, use read_bam_chunks to load it;
+       loader.load_model reads only the first chunk.
+    """
+
+    def __init__(self, filename, compress=False, layout=VertexLayout.STANDARD):
+        if compress:
+            raise ValueError('Compression is not supported for bam files.')
+
+        super().__init__(filename, compress)
+        self.layout = layout
+        self.chunk_cnt = 0
+        self.bam_file = BamFile()
+
+        if not self.bam_file.open_write(Filename.from_os_specific(str(filename))):
+            raise OSError(f'Cannot open {filename}.')
+
+    def write(self, mesh):
+        geom_node = mesh.to_geom_node(f'terraced_terrain_{self.chunk_cnt}', self.layout)
+        self.bam_file.write_object(geom_node)
+        self.chunk_cnt += 1
+
+    def close(self):
+        self.bam_file.close()
+
+
+def read_bam_chunks(filename):
+    """Load a bam file written by BamWriter and return a NodePath having the chunks.
+    """
+    bam_file = BamFile()
+    if not bam_file.open_read(Filename.from_os_specific(str(filename))):
+        raise OSError(f'Cannot open {filename}.')
+
+    root = NodePath('terraced_terrain')
+
+    try:
+        while not bam_file.is_eof():
+            if (obj := bam_file.read_object()) is None:
+                break
+            bam_file.resolve()
+            root.attach_new_node(obj)
+    finally:
+        bam_file.close()
+
+    return root
+
+
+class TerrainExporter:
+    """Export a terrain to a file in the background.
+       The terrain is generated chunk by chunk in one thread and the chunks are
+       written in another thread, so that only a few chunks are in memory at a time.
+       The file format is determined by the suffix of the filename; .ttm (indexed binary),
+       .obj and .bam. .gz can be added to .obj for compression.
+        Args:
+            generator (TerracedTerrainGenerator): the generator of the terrain.
+            filename (str): the path of the output file.
+            compress (bool): if True, the output is compressed; not supported for bam.
+            max_vertices (int): the number of vertices of a chunk.
+            queue_size (int): the maximum number of chunks waiting to be written.
+    """
+
+    writers = {'.ttm': BinaryMeshWriter, '.obj': ObjWriter, '.bam': BamWriter}
+
+    def __init__(self, generator, filename, compress=False, max_vertices=65536, queue_size=2):
+        path = pathlib.Path(filename)
+        suffixes = path.suffixes
+
+        gzipped = suffixes[-1:] == ['.gz']
+
+        if gzipped:
+            suffixes = suffixes[:-1]
+            compress = True
+
+        if not suffixes or (writer_cls := self.writers.get(suffixes[-1].lower())) is None:
+            raise ValueError(f'Unsupported file format: {filename}')
+
+        # only ObjWriter makes a gzip file; .ttm compresses its chunks inside the file.
+        if gzipped and writer_cls is not ObjWriter:
+            raise ValueError(f'.gz is supported only for .obj: {filename}')
+
+        self.generator = generator
+        self.writer = writer_cls(filename, compress)
+        self.max_vertices = max_vertices
+        self.chunks = queue.Queue(maxsize=queue_size)
+
+        self.written_chunks = 0
+        self.written_triangles = 0
+        self.error = None
+        self.cancelled = threading.Event()
+        self.threads = []
+
+    def start(self):
+        self.threads = [
+            threading.Thread(target=self.generate, daemon=True),
+            threading.Thread(target=self.write, daemon=True)
+        ]
+        for th in self.threads:
+            th.start()
+
+    def run(self):
+        """Export and wait until finished.
+        """
+        self.start()
+        self.join()
+
+    def join(self):
+        for th in self.threads:
+            th.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def is_alive(self):
+        return any(th.is_alive() for th in self.threads)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def generate(self):
+        try:
+            for mesh in self.generator.generate_mesh_chunks(self.max_vertices):
+                if not self.put(mesh):
+                    break
+        except Exception as e:
+            self.error = e
+            self.cancelled.set()
+        finally:
+            self.put(None)
+
+    def write(self):
+        try:
+            while not self.cancelled.is_set():
+                try:
+                    mesh = self.chunks.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                if mesh is None:
+                    break
+
+                self.writer.write(mesh)
+                self.written_chunks += 1
+                self.written_triangles += mesh.num_triangles
+        except Exception as e:
+            self.error = e
+            self.cancelled.set()
+        finally:
+            self.writer.close()
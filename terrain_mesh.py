@@ -0,0 +1,218 @@
+import struct
+from enum import Enum, auto
+
+import numpy as np
+from panda3d.core import Geom, GeomNode, GeomTriangles, GeomVertexData, GeomEnums
+from panda3d.core import GeomVertexFormat, GeomVertexArrayFormat
+
+
+class VertexLayout(Enum):
+    """Layouts of the vertex data written into a GeomNode.
+        STANDARD: float32 position, color, normal and uv; 48 bytes.
+        COMPACT: float32 position, uint8 color, int8 normal and float32 uv; 28 bytes.
+                 The normal is stored multiplied by 127 and Panda3D does not normalize it;
+                 GeomVertexReader returns (0, 0, 127) for an upward normal. Use only when
+                 the normals are normalized where they are read, e.g. normalize(p3d_Normal)
+                 in a shader, and not read on the CPU without dividing them by 127.
+        COMPACT_NO_UV: COMPACT without uv; 20 bytes. Use only when no texture is applied.
+    """
+
+    STANDARD = auto()
+    COMPACT = auto()
+    COMPACT_NO_UV = auto()
+
+
+class TerrainMesh:
+    """A Panda3D-independent mesh made of NumPy arrays.
+       A vertex is 12 float32 values; position(3), color(4), normal(3) and uv(2),
+       the same layout as the vdata_values of ProceduralGeometry.
+        Args:
+            vertices (numpy.ndarray): float32 array; shape is (number of vertices, 12).
+            indices (numpy.ndarray): uint32 array; shape is (number of triangles, 3).
+            levels (numpy.ndarray): int32 array; terrace level of each triangle.
+    """
+
+    stride = 12
+    header = struct.Struct('<4sII')
+    magic = b'TMSH'
+
+    def __init__(self, vertices, indices, levels=None):
+        self.vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, self.stride)
+        self.indices = np.asarray(indices, dtype=np.uint32).reshape(-1, 3)
+
+        if levels is None:
+            levels = np.zeros(len(self.indices), dtype=np.int32)
+        self.levels = np.asarray(levels, dtype=np.int32)
+
+    @classmethod
+    def from_buffers(cls, vdata_values, prim_indices, prim_levels=None):
+        """Create a mesh from array.array objects without copying them.
+        """
+        vertices = np.frombuffer(vdata_values, dtype=np.float32)
+        indices = np.frombuffer(prim_indices, dtype=np.uint32)
+        levels = None if prim_levels is None else np.frombuffer(prim_levels, dtype=np.int32)
+        return cls(vertices, indices, levels)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Restore a mesh from the bytes made by to_bytes. The arrays refer to data.
+        """
+        magic, v_cnt, t_cnt = cls.header.unpack_from(data)
+        if magic != cls.magic:
+            raise ValueError('Not a terrain mesh data.')
+
+        offset = cls.header.size
+        vertices = np.frombuffer(data, dtype=np.float32, count=v_cnt * cls.stride, offset=offset)
+        offset += vertices.nbytes
+        indices = np.frombuffer(data, dtype=np.uint32, count=t_cnt * 3, offset=offset)
+        offset += indices.nbytes
+        levels = np.frombuffer(data, dtype=np.int32, count=t_cnt, offset=offset)
+        return cls(vertices, indices, levels)
+
+    @classmethod
+    def concatenate(cls, meshes):
+        meshes = [m for m in meshes]
+        if not meshes:
+            return cls(np.empty((0, cls.stride)), np.empty((0, 3)))
+
+        starts = np.cumsum([0] + [m.num_vertices for m in meshes[:-1]], dtype=np.uint32)
+        vertices = np.concatenate([m.vertices for m in meshes])
+        indices = np.concatenate([m.indices + start for m, start in zip(meshes, starts)])
+        levels = np.concatenate([m.levels for m in meshes])
+        return cls(vertices, indices, levels)
+
+    def __getstate__(self):
+        return {'data': self.to_bytes()}
+
+    def __setstate__(self, state):
+        mesh = self.from_bytes(state['data'])
+        self.vertices, self.indices, self.levels = mesh.vertices, mesh.indices, mesh.levels
+
+    @property
+    def positions(self):
+        return self.vertices[:, 0:3]
+
+    @property
+    def colors(self):
+        return self.vertices[:, 3:7]
+
+    @property
+    def normals(self):
+        return self.vertices[:, 7:10]
+
+    @property
+    def uvs(self):
+        return self.vertices[:, 10:12]
+
+    @property
+    def num_vertices(self):
+        return len(self.vertices)
+
+    @property
+    def num_triangles(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        return self.vertices.nbytes + self.indices.nbytes + self.levels.nbytes
+
+    def to_bytes(self):
+        return b''.join([
+            self.header.pack(self.magic, self.num_vertices, self.num_triangles),
+            np.ascontiguousarray(self.vertices).tobytes(),
+            np.ascontiguousarray(self.indices).tobytes(),
+            np.ascontiguousarray(self.levels).tobytes()
+        ])
+
+    def slice(self, start, stop):
+        """Return the triangles from start to stop as a new mesh. Because the generator
+           writes the vertices of each triangle in order, the vertices are a view of
+           this mesh's vertices if they are contiguous.
+        """
+        indices = self.indices[start:stop]
+        levels = self.levels[start:stop]
+
+        if len(indices) == 0:
+            return TerrainMesh(np.empty((0, self.stride)), indices, levels)
+
+        v_min, v_max = int(indices.min()), int(indices.max())
+
+        if v_max - v_min + 1 == len(np.unique(indices)):
+            return TerrainMesh(self.vertices[v_min:v_max + 1], indices - v_min, levels)
+
+        used, new_indices = np.unique(indices, return_inverse=True)
+        return TerrainMesh(self.vertices[used], new_indices.astype(np.uint32), levels)
+
+    def create_format(self, layout=VertexLayout.STANDARD):
+        arr_format = GeomVertexArrayFormat()
+        arr_format.add_column('vertex', 3, Geom.NT_float32, Geom.C_point)
+
+        if layout == VertexLayout.STANDARD:
+            arr_format.add_column('color', 4, Geom.NT_float32, Geom.C_color)
+            arr_format.add_column('normal', 3, Geom.NT_float32, Geom.C_normal)
+            arr_format.add_column('texcoord', 2, Geom.NT_float32, Geom.C_texcoord)
+        else:
+            # uint8 color is normalized to 0-1 by Panda3D, but int8 normal is not; see VertexLayout.
+            # The normal is followed by one byte of padding to keep 4-byte alignment.
+            arr_format.add_column('color', 4, Geom.NT_uint8, Geom.C_color, 12)
+            arr_format.add_column('normal', 3, Geom.NT_int8, Geom.C_normal, 16)
+
+            if layout == VertexLayout.COMPACT:
+                arr_format.add_column('texcoord', 2, Geom.NT_float32, Geom.C_texcoord, 20)
+                arr_format.set_stride(28)
+            else:
+                arr_format.set_stride(20)
+
+        return GeomVertexFormat.register_format(arr_format)
+
+    def pack_vertices(self, layout=VertexLayout.STANDARD):
+        """Return the vertices converted into the layout as a structured array.
+        """
+        if layout == VertexLayout.STANDARD:
+            return np.ascontiguousarray(self.vertices)
+
+        names = ['vertex', 'color', 'normal']
+        formats = ['3f4', '4u1', '3i1']
+        offsets = [0, 12, 16]
+        itemsize = 20
+
+        if layout == VertexLayout.COMPACT:
+            names.append('texcoord')
+            formats.append('2f4')
+            offsets.append(20)
+            itemsize = 28
+
+        dtype = np.dtype(dict(names=names, formats=formats, offsets=offsets, itemsize=itemsize))
+        packed = np.zeros(self.num_vertices, dtype=dtype)
+        packed['vertex'] = self.positions
+        packed['color'] = np.rint(np.clip(self.colors, 0, 1) * 255)
+        packed['normal'] = np.rint(np.clip(self.normals, -1, 1) * 127)
+
+        if layout == VertexLayout.COMPACT:
+            packed['texcoord'] = self.uvs
+
+        return packed
+
+    def to_geom_node(self, name='terraced_terrain', layout=VertexLayout.STANDARD):
+        """Create a GeomNode. The arrays are copied into the Panda3D buffers
+           once without any intermediate object, unless a compact layout is specified.
+            Args:
+                name (str): the name of the GeomNode.
+                layout (VertexLayout): the layout of the vertex data.
+        """
+        vdata = GeomVertexData(name, self.create_format(layout), Geom.UH_static)
+        vdata.unclean_set_num_rows(self.num_vertices)
+        vdata.modify_array_handle(0).copy_data_from(self.pack_vertices(layout).view(np.uint8))
+
+        prim = GeomTriangles(Geom.UH_static)
+        prim.set_index_type(GeomEnums.NT_uint32)
+        prim_array = prim.modify_vertices()
+        prim_array.unclean_set_num_rows(self.num_triangles * 3)
+        prim_mem = memoryview(prim_array).cast('B')
+        prim_mem[:] = memoryview(np.ascontiguousarray(self.indices)).cast('B')
+
+        geom = Geom(vdata)
+        geom.add_primitive(prim)
+        node = GeomNode(name)
+        node.add_geom(geom)
+        return node
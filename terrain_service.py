@@ -0,0 +1,256 @@
+"""A local HTTP service to generate terraced terrains for several tools.
+
+    python terrain_service.py --port 8765 --workers 4 --cache_size 64 --cache_mb 512
+
+POST /generate with JSON parameters returns the terrain as bytes;
+TerrainMesh.to_bytes() if "format" is "mesh" (default), or a bam stream if "format" is "bam".
+    {"noise": "simplex", "scale": 8, "segs_c": 5, "radius": 3, "max_depth": 6,
+     "octaves": 3, "theme": "mountain", "seed": 1, "format": "mesh"}
+GET /metrics returns the queue depth, latency percentiles and cache hit rate as JSON.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from themes import themes
+
+
+PARAMS = {
+    'noise': str, 'scale': float, 'segs_c': int, 'radius': float,
+    'max_depth': int, 'octaves': int, 'theme': str, 'seed': int, 'format': str
+}
+NOISES = ('simplex', 'perlin', 'cellular', 'fractal')
+FORMATS = ('mesh', 'bam')
+# (minimum, maximum) of the parameters; a deeper terrain ties up a worker for too long.
+RANGES = {'segs_c': (3, 64), 'max_depth': (1, 10), 'octaves': (1, 16)}
+# the maximum of segs_c * 4 ** (max_depth - 1), the number of the triangles before terracing.
+MAX_TRIANGLES = 2 ** 20
+
+
+def validate_params(params):
+    """Return the parameters converted into their types. Raise ValueError if invalid.
+    """
+    if unknown := set(params) - set(PARAMS):
+        raise ValueError(f'Unknown parameters: {", ".join(sorted(unknown))}')
+
+    values = {k: PARAMS[k](v) for k, v in params.items()}
+    values.setdefault('noise', 'simplex')
+    values.setdefault('format', 'mesh')
+
+    if values['noise'] not in NOISES:
+        raise ValueError(f'noise must be one of {", ".join(NOISES)}.')
+    if values['format'] not in FORMATS:
+        raise ValueError(f'format must be one of {", ".join(FORMATS)}.')
+    if 'theme' in values and values['theme'].lower() not in themes:
+        raise ValueError(f'theme must be one of {", ".join(themes)}.')
+
+    for k, (lo, hi) in RANGES.items():
+        if k in values and not lo <= values[k] <= hi:
+            raise ValueError(f'{k} must be from {lo} to {hi}.')
+
+    # the defaults of TerracedTerrainGenerator are used if not specified.
+    triangles = values.get('segs_c', 5) * 4 ** (values.get('max_depth', 6) - 1)
+    if triangles > MAX_TRIANGLES:
+        raise ValueError(f'segs_c * 4 ** (max_depth - 1) must be at most {MAX_TRIANGLES}; got {triangles}.')
+
+    for k in ('scale', 'radius'):
+        if k in values and not values[k] > 0:
+            raise ValueError(f'{k} must be positive.')
+
+    if 'seed' not in values:
+        values['seed'] = random.randint(0, 2 ** 31 - 1)
+
+    return values
+
+
+def generate_terrain(params):
+    """Generate a terrain in a worker process and return its bytes.
+    """
+    from terraced_terrain_generator import TerracedTerrainGenerator
+
+    kwargs = {k: v for k, v in params.items() if k not in ('noise', 'format')}
+    generator = getattr(TerracedTerrainGenerator, f'from_{params["noise"]}')(**kwargs)
+
+    if params['format'] == 'bam':
+        return generator.create().encode_to_bam_stream()
+
+    return generator.get_mesh().to_bytes()
+
+
+class TerrainService:
+    """Run the generation in a process pool with an LRU cache of the results.
+       Identical requests in flight are coalesced into one generation.
+        Args:
+            workers (int): the number of worker processes.
+            cache_size (int): the maximum number of results kept in the cache.
+            max_queue (int): the maximum number of generations waiting or running.
+            max_cache_bytes (int): the maximum total size of the results kept in the cache;
+                                   a result larger than this is returned but not kept.
+    """
+
+    def __init__(self, workers=4, cache_size=64, max_queue=32, max_cache_bytes=512 * 2 ** 20):
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.cache_size = cache_size
+        self.max_queue = max_queue
+        self.max_cache_bytes = max_cache_bytes
+        self.cached_bytes = 0
+
+        # reentrant, because the callback runs at once if the future is already done.
+        self.lock = threading.RLock()
+        self.cache = OrderedDict()
+        self.in_flight = {}
+
+        self.requests = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.latencies = deque(maxlen=1000)
+
+    def request(self, params):
+        """Return the bytes of the terrain and how it was served; "cache", "coalesced" or "generated".
+           Raise OverflowError if too many generations are queued.
+        """
+        start = time.perf_counter()
+        key = json.dumps(params, sort_keys=True)
+
+        with self.lock:
+            self.requests += 1
+
+            if (data := self.cache.get(key)) is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                source = 'cache'
+            elif (future := self.in_flight.get(key)) is not None:
+                self.coalesced += 1
+                source = 'coalesced'
+            else:
+                if len(self.in_flight) >= self.max_queue:
+                    raise OverflowError('Too many requests in the queue.')
+
+                future = self.pool.submit(generate_terrain, params)
+                self.in_flight[key] = future
+                future.add_done_callback(lambda f: self.store(key, f))
+                source = 'generated'
+
+        if data is None:
+            data = future.result()
+
+        self.latencies.append(time.perf_counter() - start)
+        return data, source
+
+    def store(self, key, future):
+        with self.lock:
+            del self.in_flight[key]
+
+            if future.exception() is None and len(data := future.result()) <= self.max_cache_bytes:
+                self.cache[key] = data
+                self.cached_bytes += len(data)
+
+                while len(self.cache) > self.cache_size or self.cached_bytes > self.max_cache_bytes:
+                    _, evicted = self.cache.popitem(last=False)
+                    self.cached_bytes -= len(evicted)
+
+    def get_metrics(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+        with self.lock:
+            return dict(
+                queue_depth=len(self.in_flight),
+                requests=self.requests,
+                cache_hits=self.hits,
+                coalesced=self.coalesced,
+                cache_hit_rate=self.hits / self.requests if self.requests else 0.0,
+                cached_results=len(self.cache),
+                cached_bytes=self.cached_bytes,
+                latency_p50=percentile(50),
+                latency_p90=percentile(90),
+                latency_p99=percentile(99),
+            )
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+class TerrainRequestHandler(BaseHTTPRequestHandler):
+
+    service = None
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, obj):
+        self.send_body(status, json.dumps(obj).encode())
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(HTTPStatus.OK, self.service.get_metrics())
+        else:
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': 'not found'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = validate_params(json.loads(self.rfile.read(length) or b'{}'))
+        except (ValueError, TypeError) as e:
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+            return
+
+        try:
+            data, source = self.service.request(params)
+        except OverflowError as e:
+            self.send_json(HTTPStatus.SERVICE_UNAVAILABLE, {'error': str(e)})
+        except Exception as e:
+            self.send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)})
+        else:
+            headers = {'X-Terrain-Seed': str(params['seed']), 'X-Terrain-Source': source}
+            self.send_body(HTTPStatus.OK, data, 'application/octet-stream', headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local terraced terrain generation service.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--cache_size', type=int, default=64)
+    parser.add_argument('--max_queue', type=int, default=32)
+    parser.add_argument('--cache_mb', type=int, default=512, help='the maximum total size of the cache in MB.')
+    args = parser.parse_args()
+
+    TerrainRequestHandler.service = TerrainService(
+        args.workers, args.cache_size, args.max_queue, args.cache_mb * 2 ** 20)
+    server = ThreadingHTTPServer((args.host, args.port), TerrainRequestHandler)
+    print(f'serving on http://{args.host}:{args.port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        TerrainRequestHandler.service.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+import array
+import random
+
+from panda3d.core import NodePath, Point3
+
+from lattice import Lattice
+from terraced_terrain_generator import TerracedTerrainGenerator
+
+
+class TerrainTile(TerracedTerrainGenerator):
+    """A class to generate a square tile of a terraced terrain.
+       Heights are calculated from world coordinates, so tiles sharing
+       the same noise, parameters and seed join without seams.
+        Args:
+            noise (func): Function that generates noise.
+            tx (int): x index of the tile in the grid.
+            ty (int): y index of the tile in the grid.
+            tile_size (float): length of a side of the tile.
+            scale (float): The smaller this value is, the more sparse the noise becomes.
+            max_depth (int): The number of times that the four triangles forming the tile are divided.
+            octaves (int): The number of loops to calculate the height of the vertex coordinates.
+            theme (str): one of "mountain", "snowmountain" and "desert".
+            seed (int): seed for the noise offsets; must be the same for all tiles.
+    """
+
+    def __init__(self, noise, tx, ty, tile_size=8, scale=10,
+                 max_depth=6, octaves=3, theme='mountain', seed=0):
+        super().__init__(noise, scale, 4, tile_size / 2 ** 0.5, max_depth, octaves, theme, seed)
+        self.tx = tx
+        self.ty = ty
+        self.tile_size = tile_size
+        self.center = Point3((tx + 0.5) * tile_size, (ty + 0.5) * tile_size, 0)
+
+    def generate_basic_polygon(self):
+        """Generate the four sides of the tile. The corners are calculated
+           from the tile indices, not from the center, so that adjacent tiles
+           get exactly the same coordinates on their shared side.
+        """
+        x0, x1 = self.tx * self.tile_size, (self.tx + 1) * self.tile_size
+        y0, y1 = self.ty * self.tile_size, (self.ty + 1) * self.tile_size
+        corners = [(x1, y1), (x0, y1), (x0, y0), (x1, y0)]
+
+        for (x_1, y_1), (x_2, y_2) in zip(corners, corners[1:] + corners[:1]):
+            yield (Point3(x_1, y_1, 0), Point3(x_2, y_2, 0))
+
+    def get_lattice_key(self):
+        # the lattice is built relative to the tile, so that all the tiles of the same size share it.
+        return (type(self).__qualname__, self.tile_size, self.max_depth)
+
+    def create_lattice(self):
+        s = self.tile_size
+        center = Point3(s / 2, s / 2, 0)
+        corners = [(s, s), (0, s), (0, 0), (s, 0)]
+        triangles = (
+            tri
+            for (x_1, y_1), (x_2, y_2) in zip(corners, corners[1:] + corners[:1])
+            for tri in self.generate_triangles([Point3(x_1, y_1, 0), Point3(x_2, y_2, 0), center])
+        )
+        return Lattice.from_triangles(self.watch_cancel(triangles))
+
+    def get_lattice_points(self, lattice):
+        """Translate the lattice to the tile. The vertices on the sides are put exactly
+           on the coordinates calculated from the tile indices, so that adjacent tiles
+           get the same coordinates on their shared side.
+        """
+        x0, x1 = self.tx * self.tile_size, (self.tx + 1) * self.tile_size
+        y0, y1 = self.ty * self.tile_size, (self.ty + 1) * self.tile_size
+        # the far side of the lattice, as stored through Point3.
+        far = Point3(self.tile_size, 0, 0).x
+
+        xs = array.array('d', [x0 if x == 0 else x1 if x == far else x0 + x for x in lattice.xs])
+        ys = array.array('d', [y0 if y == 0 else y1 if y == far else y0 + y for y in lattice.ys])
+        return xs, ys
+
+    def calc_uv(self, x, y):
+        # the texture spans the square tile, not the circle around it, so that it joins the next tiles.
+        half = self.tile_size / 2
+        u = 0.5 + (x - self.center.x) / half * 0.5
+        v = 0.5 + (y - self.center.y) / half * 0.5
+        return u, v
+
+    def get_geom_node(self):
+        geom_node = super().get_geom_node()
+        geom_node.set_name(f'terrain_tile_{self.tx}_{self.ty}')
+        return geom_node
+
+
+class TiledTerrain:
+    """A class to generate a large terraced terrain as a grid of tiles,
+       each of which is an own GeomNode. Tiles around the focus point are
+       generated on demand and tiles far from it are removed.
+       The island theme is not suitable, because its mask is not tiled.
+        Args:
+            generator (TerracedTerrainGenerator): supplies noise, scale, max_depth, octaves, theme
+                                                  and the settings in tile_settings.
+            tile_size (float): length of a side of a tile.
+            load_radius (int): tiles within this distance (in tiles) from the focus point are generated.
+            unload_radius (int): tiles farther than this distance (in tiles) are removed.
+            max_tiles_per_update (int): the maximum number of tiles generated in one update.
+    """
+
+    # the settings of the generator, which are not arguments of TerrainTile, passed to the tiles.
+    tile_settings = (
+        'terrace_height', 'frequency', 'persistence', 'lacunarity',
+        'vertex_layout', 'optimize_vertex_cache', 'build_height_index'
+    )
+
+    def __init__(self, generator, tile_size=8, load_radius=2, unload_radius=3,
+                 max_tiles_per_update=1):
+        if unload_radius < load_radius:
+            raise ValueError('unload_radius must be greater than or equal to load_radius.')
+
+        self.generator = generator
+        self.tile_size = tile_size
+        self.load_radius = load_radius
+        self.unload_radius = unload_radius
+        self.max_tiles_per_update = max_tiles_per_update
+
+        if (seed := generator.seed) is None:
+            seed = random.randint(0, 2 ** 31 - 1)
+        self.seed = seed
+
+        self.root = NodePath('tiled_terrain')
+        self.tiles = {}
+
+    def get_tile_index(self, x, y):
+        return int(x // self.tile_size), int(y // self.tile_size)
+
+    def create_tile(self, tx, ty):
+        tile = TerrainTile(
+            self.generator.noise, tx, ty, self.tile_size, self.generator.scale,
+            self.generator.max_depth, self.generator.octaves,
+            self.generator.theme.__name__, self.seed
+        )
+        for name in self.tile_settings:
+            setattr(tile, name, getattr(self.generator, name))
+
+        model = tile.create()
+        model.reparent_to(self.root)
+        self.tiles[(tx, ty)] = model
+
+        return model
+
+    def remove_tile(self, tx, ty):
+        if (model := self.tiles.pop((tx, ty), None)) is not None:
+            model.remove_node()
+
+    def update(self, focus):
+        """Generate missing tiles around the focus point, nearest first,
+           and remove tiles out of unload_radius. Return True while tiles
+           remain to be generated.
+            Args:
+                focus (Point3): the point, usually the camera or the player position.
+        """
+        cx, cy = self.get_tile_index(focus.x, focus.y)
+
+        for tx, ty in [k for k in self.tiles.keys()]:
+            if max(abs(tx - cx), abs(ty - cy)) > self.unload_radius:
+                self.remove_tile(tx, ty)
+
+        r = self.load_radius
+        missing = [(tx, ty) for tx in range(cx - r, cx + r + 1)
+                   for ty in range(cy - r, cy + r + 1) if (tx, ty) not in self.tiles]
+        missing.sort(key=lambda k: (k[0] - cx) ** 2 + (k[1] - cy) ** 2)
+
+        for tx, ty in missing[:self.max_tiles_per_update]:
+            self.create_tile(tx, ty)
+
+        return len(missing) > self.max_tiles_per_update
+
+    def clear(self):
+        for tx, ty in [k for k in self.tiles.keys()]:
+            self.remove_tile(tx, ty)